@@ -6,6 +6,8 @@ import shutil
 import subprocess
 import sys
 
+from .glue import glue_output
+
 class ZeusMP:
 
     def __init__(self, zeus_config):
@@ -18,8 +20,12 @@ class ZeusMP:
         self.fullexedir = os.path.join(self.zeusdir, self.exedir)
         self.fullsrcdir = os.path.join(self.zeusdir, self.srcdir)
 
-    def run(self, nproc = 1):
-        """Run ZEUS-MP2 and post-process the output"""
+    def run(self, nproc = 1, nglue = 1, zmp_pp = False):
+        """Run ZEUS-MP2 and post-process the output
+
+        The per-rank tiles are glued into hdfaa.NNN dumps by glue_output,
+        using nglue processes, or by the serial zmp_pp.x if zmp_pp is set.
+        """
 
         fstdout = open(os.path.join(self.fullexedir, "zmp.stdout"), 'w')
 
@@ -38,6 +44,10 @@ class ZeusMP:
 
         fstdout.close()
 
+        if not zmp_pp:
+            glue_output(self.fullexedir, nworkers = nglue, overwrite = True)
+            return
+
         try:
             # run included post-processing routine
             pp = subprocess.Popen(os.path.join(self.fullexedir, "zmp_pp.x"),
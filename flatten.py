@@ -1,6 +1,16 @@
+from collections import OrderedDict
+import concurrent.futures
+import copy
+import functools
+import h5py
+import hashlib
 import helmholtz
 import numpy as np
-from scipy.interpolate import interp1d
+import os
+import time
+import tracemalloc
+
+from .output import ZeusData
 
 # this module provides the ability to average a zeus run along a specified axis
 
@@ -29,198 +39,939 @@ class OneD:
             np.savetxt("{}.1DX".format(filename), 
                        np.transpose(self.X), fmt = '%10.3E ')
 
+    def arrays(self):
+        """Every attribute that is set, as numpy arrays"""
+        return OrderedDict((k, np.asarray(v)) for k, v in sorted(vars(self).items())
+                           if v is not None)
+
+    def save(self, filename):
+        """Write all attributes at full precision to an .npz file"""
+        np.savez(filename, **self.arrays())
+
+    @classmethod
+    def load(cls, filename):
+        """Read a profile written by save"""
+        sdata = cls()
+        with np.load(filename) as f:
+            for k in f.files:
+                v = f[k]
+                setattr(sdata, k, v[()] if v.ndim == 0 else v)
+        return sdata
+
+    def append(self, filename, dump = None):
+        """Append this profile as the next dump of a time-indexed series
+
+        dump is the name of the dump it came from, recorded in the
+        series' files attribute.
+        """
+        append_series(filename, self.arrays(), dump)
+
+    @classmethod
+    def from_series(cls, filename, n):
+        """Profile of dump n of a time-indexed series"""
+        sdata = cls()
+        with h5py.File(filename, "r") as f:
+            for k, dset in f.items():
+                v = dset[n]
+                setattr(sdata, k, v[()] if np.ndim(v) == 0 else v)
+        return sdata
+
+
+# time-indexed series files hold one HDF5 dataset per quantity, each
+# with a leading (resizable) time axis; datasets are read lazily, so
+# open the file with h5py to pull out single dumps or radii cheaply.
+# Resizable datasets are chunked and cannot be memory-mapped (nor can
+# .npz files), so finalize_series rewrites a finished series with
+# contiguous datasets, which memmap_series then maps without reading.
+
+def write_series(filename, series, files = None):
+    """Write an OrderedDict of (time, ...) arrays as a series file"""
+
+    lengths = set(len(values) for values in series.values())
+    if len(lengths) > 1:
+        raise ValueError("series quantities have different lengths {}".format(sorted(lengths)))
+    ntime = lengths.pop() if lengths else 0
+
+    with h5py.File(filename, "w") as f:
+        if files is not None:
+            f.attrs["files"] = [os.path.basename(name) for name in files]
+        if "t" not in series:
+            # always keep a (possibly empty) time axis for append_series
+            f.create_dataset("t", shape = (ntime,), dtype = np.float64,
+                             chunks = True, maxshape = (None,),
+                             fillvalue = np.nan)
+        for q, values in series.items():
+            values = np.asarray(values)
+            f.create_dataset(q, data = values, chunks = True,
+                             maxshape = (None,) + values.shape[1:])
+        f.attrs["ntime"] = ntime
+
+    return
+
+def append_series(filename, values, dump = None):
+    """Append one dump's quantities (name -> array) to a series file
+
+    Quantities new to the file are back-filled with NaN for earlier
+    dumps; quantities missing from this dump are left as NaN.  dump is
+    the name of the dump, appended to the files attribute (which is
+    kept one entry per time, with "" where the name is unknown).  A
+    finalized series becomes resizable again.
+    """
+
+    with h5py.File(filename, "a") as f:
+        # the data, not the attribute, says how many times are stored
+        n = max([dset.shape[0] for dset in f.values()] or [int(f.attrs.get("ntime", 0))])
+
+        for q in list(f):
+            if f[q].chunks is None:
+                # finalized: swap in a resizable copy
+                data = f[q][()]
+                del f[q]
+                f.create_dataset(q, data = data, chunks = True,
+                                 maxshape = (None,) + data.shape[1:])
+
+        for q, value in values.items():
+            value = np.asarray(value)
+            if q not in f:
+                fill = np.nan if value.dtype.kind == "f" else 0
+                f.create_dataset(q, shape = (n,) + value.shape,
+                                 dtype = value.dtype, chunks = True,
+                                 maxshape = (None,) + value.shape,
+                                 fillvalue = fill)
+            elif f[q].shape[1:] != value.shape:
+                raise ValueError("{} has shape {}, series has {}".format(
+                    q, value.shape, f[q].shape[1:]))
+
+        for q, dset in f.items():
+            dset.resize(n + 1, axis = 0)
+            if q in values:
+                dset[n] = values[q]
+
+        if dump is not None or "files" in f.attrs:
+            files = [str(name) for name in f.attrs.get("files", [""] * n)]
+            files.append("" if dump is None else os.path.basename(dump))
+            f.attrs["files"] = files
+
+        f.attrs["ntime"] = n + 1
+
+    return
+
+def finalize_series(filename):
+    """Rewrite a series file with contiguous datasets, for memmap_series"""
+
+    tmp = filename + ".tmp"
+    with h5py.File(filename, "r") as src, h5py.File(tmp, "w") as dst:
+        for key, value in src.attrs.items():
+            dst.attrs[key] = value
+        for q, dset in src.items():
+            dst.create_dataset(q, data = dset[()])
+    os.replace(tmp, filename)
+
+    return
+
+def memmap_series(filename):
+    """Memory-map the datasets of a finalized series file
+
+    Returns an OrderedDict of read-only np.memmap arrays.  Raises
+    ValueError for datasets that are chunked (see finalize_series).
+    """
+
+    series = OrderedDict()
+    with h5py.File(filename, "r") as f:
+        for q, dset in f.items():
+            offset = dset.id.get_offset()
+            if dset.chunks is not None or offset is None:
+                if dset.size == 0:
+                    series[q] = np.empty(dset.shape, dtype = dset.dtype)
+                    continue
+                raise ValueError("{} is not contiguous; finalize_series first".format(q))
+            series[q] = np.memmap(filename, mode = "r", dtype = dset.dtype,
+                                  shape = dset.shape, offset = offset)
+
+    return series
+
+def read_series(filename):
+    """Read a series file into an OrderedDict of (time, ...) arrays"""
+
+    with h5py.File(filename, "r") as f:
+        return OrderedDict((q, dset[()]) for q, dset in f.items())
+
+def remap_to_mass(profiles, mgrid, quantities = None):
+    """Interpolate many profiles onto a common enclosed-mass grid
+
+    profiles is a list of OneD or a series (an OrderedDict of (time,
+    radius) arrays, as from flatten_run or read_series).  The bracketing
+    indices and weights in menc are found once per dump, for all dumps
+    at once, and reused for every quantity.  Returns
+    an OrderedDict of (time, len(mgrid)) arrays (X is (time, species,
+    len(mgrid))), NaN outside each dump's mass range.
+    """
+
+    if not isinstance(profiles, dict):
+        keys = set.intersection(*[set(vars(p)) for p in profiles])
+        profiles = OrderedDict((q, np.array([getattr(p, q) for p in profiles]))
+                               for q in series_quantities + ("P", "v3", "t")
+                               if q in keys)
+
+    menc = np.asarray(profiles["menc"], dtype = np.float64)
+    ntime, nr = menc.shape
+    mgrid = np.asarray(mgrid, dtype = np.float64)
+    target = np.broadcast_to(mgrid, (ntime, mgrid.size))
+
+    idx = np.clip(_rowwise_searchsorted(menc, target), 1, nr - 1)
+    m0 = np.take_along_axis(menc, idx - 1, axis = 1)
+    m1 = np.take_along_axis(menc, idx, axis = 1)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        w = np.clip(np.where(m1 > m0, (target - m0) / (m1 - m0), 0.0), 0.0, 1.0)
+    outside = (target < menc[:, :1]) | (target > menc[:, -1:])
+
+    if quantities is None:
+        quantities = [q for q, v in profiles.items()
+                      if q != "menc" and np.ndim(v) >= 2 and np.shape(v)[-1] == nr]
+
+    remapped = OrderedDict()
+    if "t" in profiles:
+        remapped["t"] = np.asarray(profiles["t"])
+    remapped["menc"] = np.array(target)
+
+    for q in quantities:
+        v = np.asarray(profiles[q], dtype = np.float64)
+        # line the (time, m) indices up with any middle axes, e.g. species
+        shape = (ntime,) + (1,) * (v.ndim - 2) + (mgrid.size,)
+        i0 = np.reshape(idx - 1, shape)
+        wq = np.reshape(w, shape)
+        out = ((1.0 - wq) * np.take_along_axis(v, i0, axis = -1) +
+               wq * np.take_along_axis(v, i0 + 1, axis = -1))
+        out[np.broadcast_to(np.reshape(outside, shape), out.shape)] = np.nan
+        remapped[q] = out
+
+    return remapped
+
+
+# profiles that oned can produce
+all_profiles = ("menc", "d", "e", "X", "T", "v3", "omega", "j", "mdot", "aspect")
+
+
+def _field_shape(data):
+    return tuple(np.size(c) for c in (data.x3, data.x2, data.x1) if np.size(c) > 1)
+
+class _Geometry:
+    """Angular weights of a grid, for contracting fields to radial profiles
+
+    Fields of shape (angles..., nr) are viewed as (nang, nr), and every
+    angular average is a contraction with a row of W:
+
+        W[0]  volume weights, whole sphere
+        W[1]  volume weights, equatorial wedge (x2 > 3 pi / 8)
+        W[2]  volume weights times sin(x2), for the cylindrical radius
+
+    and M marks the cells summed for the mass flux.  wedges() keeps
+    the same weights but assigns every row to a polar-angle wedge
+    (bins), and the weighted rows are then added up per wedge, so every
+    profile gets a leading wedge axis.  vol is the total of W[0] (per
+    wedge, if any).  The radial volume factor dV1 cancels from every
+    average and only enters the enclosed mass.
+    """
+
+    def __init__(self, data):
+
+        # shape of a squeezed field, worked out without reading one
+        self.shape = _field_shape(data)
+        self.ndim = len(self.shape)
+        self.nr = data.x1.size
+        self.x1 = data.x1
+        self.dV1 = data.dV1
+
+        if self.ndim == 3:
+            nk = np.size(data.x3)
+            dVang = np.outer(data.dV3, data.dV2).ravel()
+            x2 = np.tile(data.x2, nk)
+        else:
+            dVang = np.atleast_1d(data.dV2 * data.dV3)
+            x2 = np.atleast_1d(data.x2)
 
-# define average functions
+        self.x2 = x2
+        self.W = np.array([dVang,
+                           dVang * (x2 > 3.0 * np.pi / 8.0),
+                           dVang * np.sin(x2)])
+        self.M = np.ones_like(dVang)
+        self.vol = np.sum(dVang)
 
-def weightedavg_2d(field, weight, slice):
-    return (np.sum(field[slice,:] * weight[slice,:], axis = 0) / 
-            np.sum(weight[slice,:], axis = 0))
+        # no wedges: every row goes into the one whole-grid sum
+        self.bins = None
+        self.nbin = None
 
-def Xweightedavg_2d(field, weight):
-    return (np.sum(field * weight,  axis = 1) / 
-            np.sum(weight, axis = 0))
+        # 2D rotation is taken from the equator, 3D from the whole sphere
+        self.v3_row = 1 if self.ndim == 2 else 0
 
-def weightedavg_3d(field, weight):
-    return (np.sum(np.sum(field * weight, axis = 0),axis = 0) / 
-            np.sum(np.sum(weight, axis = 0),axis = 0))
+        if self.ndim == 2 and max(data.x2) < 2:
+            self.msun = 2.0e33 * 0.5 #(fudge)
+        else:
+            self.msun = 2.0e33
 
-def Xweightedavg_3d(field, weight):
-    return (np.sum(np.sum(field * weight,  axis = 1),axis=1) / 
-            np.sum(np.sum(weight, axis = 0), axis = 0))
+    def wedges(self, edges):
+        """Copy of this geometry with one set of weights per x2 wedge
 
+        A cell belongs to wedge b if edges[b] <= x2 < edges[b+1].
+        Rows outside all wedges go into an extra bin nbin, which is
+        dropped.  Rotation is taken from the whole of each wedge.
+        """
 
-def twod_to_oned(data):
+        edges = np.asarray(edges, dtype = np.float64)
+        nbin = edges.size - 1
+        which = np.digitize(self.x2, edges) - 1
+        which[(which < 0) | (which >= nbin)] = nbin
 
-    sdata = OneD()
+        geom = copy.copy(self)
+        geom.bins = which
+        geom.nbin = nbin
+        geom.vol = np.bincount(which, weights = self.W[0], minlength = nbin + 1)[:nbin,None]
+        geom.v3_row = 0
+
+        return geom
+
+    def flat(self, field):
+        """View a field of shape (..., angles..., nr) as (..., nang, nr)"""
+        if field is None:
+            return None
+        lead = np.shape(field)[:np.ndim(field) - self.ndim]
+        return np.reshape(field, lead + (-1, self.nr))
+
+
+class GeometryCache:
+    """Keep the _Geometry of each distinct grid seen, up to maxsize grids
+
+    Grids are keyed on a digest of the coordinate and volume arrays, so
+    every dump of a run shares one set of angular weights.
+    """
+
+    def __init__(self, maxsize = 8):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def key(data):
+        h = hashlib.sha1()
+        h.update(str(_field_shape(data)).encode())
+        for alias in ("x1", "x2", "x3", "dV1", "dV2", "dV3"):
+            h.update(np.ascontiguousarray(getattr(data, alias)).tobytes())
+        return h.hexdigest()
+
+    def get(self, data):
+        key = self.key(data)
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        geom = _Geometry(data)
+        self._cache[key] = geom
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last = False)
+
+        return geom
+
+    def clear(self):
+        self._cache.clear()
+
+# shared by all flattening calls unless one is given explicitly
+geometry_cache = GeometryCache()
+
+
+def _needs(profiles):
+    # which weighted sums a set of profiles depends on
+    return {"e"  : bool(profiles & {"e", "T"}),
+            "T"  : "T" in profiles,
+            "v3" : bool(profiles & {"v3", "omega", "j"}),
+            "v1" : "mdot" in profiles,
+            "X"  : bool(profiles & {"X", "T"})}
+
+def _weighted_sums(geom, fields, profiles, rows = slice(None)):
+    """Angular sums of the weighted fields over the given angular rows
+
+    fields maps aliases to (nang, nr) arrays (X is (nspec, nang, nr))
+    restricted to rows.  The sums are additive, so a grid may be
+    processed piecewise and the results added together.
+    """
+
+    needs = _needs(profiles)
+    d = fields["d"]
+
+    if geom.bins is not None:
+        return _binned_sums(geom, fields, needs, rows)
+
+    W = geom.W[..., rows]
+
+    sums = {"d": np.dot(W, d)}
+
+    if needs["e"]:
+        sums["e"] = np.dot(W[0], fields["e"])
+    if needs["T"]:
+        sums["T"] = np.einsum("...a,ar,ar->...r", W[0], d, fields["T"])
+    if needs["v3"]:
+        sums["v3"] = np.einsum("w...a,ar,ar->w...r", W, d, fields["v3"])
+    if needs["v1"]:
+        sums["v1"] = np.einsum("...a,ar,ar->...r", geom.M[..., rows], d, fields["v1"])
+    if needs["X"] and fields.get("X") is not None:
+        sums["X"] = np.einsum("...a,ar,sar->s...r", W[0], d, fields["X"])
+
+    return sums
+
+def _binned_sums(geom, fields, needs, rows):
+    # _weighted_sums for wedges: each row is weighted once and the
+    # weighted rows are added into their wedge with one bincount over
+    # (wedge, radius) indices, whatever the number of wedges
+    d = fields["d"]
+    nr = d.shape[-1]
+    size = (geom.nbin + 1) * nr
+    index = (geom.bins[rows][:,None] * nr + np.arange(nr)).ravel()
+
+    def binned(values):
+        lead = values.shape[:-2]
+        flat = values.reshape(-1, index.size)
+        out = np.empty((flat.shape[0], size))
+        for n, row in enumerate(flat):
+            out[n] = np.bincount(index, weights = row, minlength = size)
+        return out[:, :geom.nbin * nr].reshape(lead + (geom.nbin, nr))
+
+    dW = geom.W[:, rows, None] * d
+    sums = {"d": binned(dW)}
 
-    # spherical radius
-    sdata.N = data.x1.size
-    sdata.r = data.x1
+    if needs["e"]:
+        sums["e"] = binned(geom.W[0, rows, None] * fields["e"])
+    if needs["T"]:
+        sums["T"] = binned(dW[0] * fields["T"])
+    if needs["v3"]:
+        sums["v3"] = binned(dW * fields["v3"])
+    if needs["v1"]:
+        sums["v1"] = binned(d * fields["v1"])
+    if needs["X"] and fields.get("X") is not None:
+        sums["X"] = binned(dW[0] * fields["X"])
+
+    return sums
+
+def _composition(X, A, Z):
+    """abar and zbar from averaged mass fractions X (species first)"""
+
+    if X is not None:
 
-    # cylindrical radius
-    RR = np.outer(np.sin(data.x2), data.x1)
+        # calculate mass fractions
+        a = np.reshape(A, (-1,) + (1,) * (np.ndim(X) - 1))
+        z = np.reshape(Z, a.shape)
 
-    # volume & mass weights
-    dV = data.dV1[None,:] * data.dV2[:,None] * data.dV3
-    dm = data.d * dV
+        abar = 1.0 / np.sum(X / a, axis = 0)
+        zbar = abar *  np.sum(z / a * X, axis = 0)
 
-    # define equatorial and polar slices
-    polar, = np.where(data.x2 < np.pi / 8.0)
-    equatorial, = np.where(data.x2 > 3.0 * np.pi / 8.0)
-    full, = np.where(data.x2 != -1)
+    elif A is not None:
 
-    # enclosed mass (spherical)
-    dmr = np.sum(dm, axis = 0)
-    if max(data.x2) < 2:
-        msun = 2.0e33 * 0.5 #(fudge)
+        abar = A
+        zbar = Z
+            
     else:
-        msun = 2.0e33
+        # assume CO
+        abar = 96.0/7.0
+        zbar = 48.0/7.0
 
-    sdata.menc = np.cumsum(dmr) / msun
+    return abar, zbar
 
-    dj = dm * data.v3 * RR
+def _blocked_sums(geom, fields, profiles, block):
+    """_weighted_sums over block angular rows at a time
 
-    # internal energy & density
-    sdata.e = weightedavg_2d(data.e, dV, full)
-    sdata.d = weightedavg_2d(data.d, dV, full)
+    Each block is copied into a float64 buffer allocated once per field
+    and reused for every block, and the products inside the sums are
+    fused into the contractions, so the only temporaries are the
+    buffers themselves.
+    """
 
-    # calculate abar & zbar
-    if data.X is not None: 
+    nang = fields["d"].shape[-2]
+    buffers = dict((alias, np.empty(field.shape[:-2] + (min(block, nang), geom.nr)))
+                   for alias, field in fields.items() if field is not None)
 
-        sdata.X = Xweightedavg_2d(data.X, dm)
+    sums = {}
+    for start in range(0, nang, block):
+        stop = min(start + block, nang)
+        chunk = {}
+        for alias, buf in buffers.items():
+            out = buf[..., :stop - start, :]
+            np.copyto(out, fields[alias][..., start:stop, :])
+            chunk[alias] = out
+        for key, value in _weighted_sums(geom, chunk, profiles, slice(start, stop)).items():
+            sums[key] = value if key not in sums else sums[key] + value
 
-        # calculate mass fractions
+    return sums
 
-        abar = 1.0 / np.sum(sdata.X / data.A[:,None], axis = 0)
-        zbar = abar *  np.sum(data.Z[:,None] / data.A[:,None] * 
-                              sdata.X , axis = 0)
-        sdata.abar = abar
-        sdata.zbar = zbar
+def _profiles(geom, sums, A, Z, profiles, eos = True):
+    """Turn accumulated weighted sums into a OneD"""
 
-    else:
+    sdata = OneD()
 
-        if data.A is not None:
+    # spherical radius
+    sdata.N = geom.nr
+    sdata.r = geom.x1
 
-            abar = data.A
-            zbar = data.Z
-            
-        else:
-            # assume CO
-            abar = 96.0/7.0
-            zbar = 48.0/7.0
+    # weight normalizations, each computed once (per wedge, if any)
+    vol = geom.vol
+    mass = sums["d"][0]
+
+    # empty wedges have no mass and get NaN profiles
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+
+        # enclosed mass (spherical)
+        if "menc" in profiles:
+            sdata.menc = np.cumsum(geom.dV1 * mass, axis = -1) / geom.msun
+
+        # internal energy & density
+        if "d" in profiles or "T" in profiles:
+            sdata.d = mass / vol
+        if "e" in sums:
+            sdata.e = sums["e"] / vol
+
+        # calculate abar & zbar
+        if "X" in sums:
 
-        sdata.abar = abar * np.ones_like(data.x1)
-        sdata.zbar = zbar * np.ones_like(data.x1)
+            sdata.X = sums["X"] / mass
+            abar, zbar = _composition(sdata.X, A, Z)
+            sdata.abar = abar
+            sdata.zbar = zbar
 
-    # guess for temp
-    tguess = weightedavg_2d(data.T, dm,full)
+        elif _needs(profiles)["X"]:
 
-    # call eos to derive temperature, entropy, etc
-    H = helmholtz.helmeos_DE(sdata.d, sdata.e, abar, zbar, tguess = tguess) 
+            abar, zbar = _composition(None, A, Z)
+            sdata.abar = abar * np.ones_like(mass)
+            sdata.zbar = zbar * np.ones_like(mass)
 
-    # put eos results
-    sdata.T = H.temp
-    sdata.s = H.stot
-    sdata.P = H.ptot
+        if "T" in profiles:
 
-    # rotation data, taken from the equator
+            # guess for temp
+            sdata.tguess = sums["T"] / mass
 
-    sdata.v3 = weightedavg_2d(data.v3, dm, equatorial)
-    sdata.omega = sdata.v3 / sdata.r
-    sdata.j  = weightedavg_2d(RR * data.v3, dm, full)
+        # rotation data
+        if "v3" in sums:
+            row = geom.v3_row
+            sdata.v3 = sums["v3"][row] / sums["d"][row]
+            sdata.omega = sdata.v3 / sdata.r
+            sdata.j = geom.x1 * sums["v3"][2] / mass
+
+    if "T" in profiles and eos:
+
+        # call eos to derive temperature, entropy, etc, only where
+        # there is mass to describe
+        valid = mass > 0
+        H = helmholtz.helmeos_DE(sdata.d[valid], sdata.e[valid],
+                                 np.broadcast_to(abar, mass.shape)[valid],
+                                 np.broadcast_to(zbar, mass.shape)[valid],
+                                 tguess = sdata.tguess[valid])
+
+        # put eos results
+        sdata.T, sdata.s, sdata.P = [np.full(mass.shape, np.nan) for _ in range(3)]
+        sdata.T[valid] = H.temp
+        sdata.s[valid] = H.stot
+        sdata.P[valid] = H.ptot
 
     # mass loss rate through outer boundary
-    sdata.mdot = np.sum(data.d * data.v1, axis = 0) * data.x1**2
+    if "v1" in sums:
+        sdata.mdot = sums["v1"] * geom.x1**2
 
-    # aspect ratio is useful for determining the final state
-    pole = 0
-    equator = -1
-
-    logr = np.log10(np.flipud(data.x1))
-    logdpole = np.flipud(np.log10(data.d[pole,   :].flatten()))
-    logdequator = np.log10(data.d[equator,   :])
-    
-    flogrpole = interp1d(logdpole,logr, bounds_error = False)
-    sdata.aspect = np.nan_to_num(np.exp(np.log10(data.x1) - flogrpole(logdequator)))
     return sdata
 
+def _rowwise_searchsorted(a, v):
+    """np.searchsorted(a[n], v[n]) for every row n of 2D arrays at once
 
-def threed_to_oned(data):
+    Rows of a must be sorted (NaN last, as for np.searchsorted).  All
+    rows are bisected together, comparing the values themselves, so
+    the indices are exact; the loop runs log2(a.shape[1]) times.
+    """
 
-    sdata = OneD()
+    n = a.shape[1]
+    lo = np.zeros(v.shape, dtype = np.intp)
+    hi = np.full(v.shape, n, dtype = np.intp)
+    vnan = np.isnan(v)
 
-    # spherical radius
-    sdata.N = data.x1.size
-    sdata.r = data.x1
+    for _ in range(int(n).bit_length()):
+        mid = (lo + hi) // 2
+        am = np.take_along_axis(a, np.minimum(mid, n - 1), axis = 1)
+        right = (lo < hi) & ((am < v) | (vnan & ~np.isnan(am)))
+        left = (lo < hi) & ~right
+        lo = np.where(right, mid + 1, lo)
+        hi = np.where(left, mid, hi)
 
-    # cylindrical radius
-    RR = np.outer(np.sin(data.x2), data.x1)
+    return lo
 
-    # volume & mass weights
-    dV = data.dV1[None,None,:] * data.dV2[None,:,None] * data.dV3[:,None,None]
-    dm = data.d * dV
+def isodensity(x1, d, levels):
+    """Radius at which the density along each ray falls to each level
 
-    # enclosed mass (spherical)
-    dmr = np.sum(np.sum(dm, axis = 0), axis = 0)
-    msun = 2.0e33
+    d has shape (rays..., nr) and levels shape (nlev,) or (rays...,
+    nlev).  Along each ray the density is made monotone by taking the
+    running minimum outward, then log10 r is interpolated linearly in
+    log10 d.  Returns radii of shape (rays..., nlev), NaN where a level
+    lies outside the density range of a ray.
+    """
 
-    sdata.menc = np.cumsum(dmr) / msun
+    d = np.asarray(d, dtype = np.float64)
+    lead = d.shape[:-1]
+    nr = d.shape[-1]
+    tiny = np.finfo(np.float64).tiny
 
-#    dj = dm * data.v3 * RR
+    # outward running minimum, reversed so each row increases
+    logd = np.log10(np.maximum(np.minimum.accumulate(d.reshape(-1, nr), axis = 1),
+                               tiny))[:, ::-1]
+    logr = np.log10(x1)[::-1]
 
-    # internal energy & density
-    sdata.e = weightedavg_3d(data.e, dV)
-    sdata.d = weightedavg_3d(data.d, dV)
+    levels = np.log10(np.maximum(np.asarray(levels, dtype = np.float64), tiny))
+    logv = np.broadcast_to(levels, lead + levels.shape[-1:]).reshape(logd.shape[0], -1)
 
-    # calculate abar & zbar
-    if data.X is not None: 
+    idx = np.clip(_rowwise_searchsorted(logd, logv), 1, nr - 1)
+    rows = np.arange(logd.shape[0])[:,None]
 
-        sdata.X = Xweightedavg_3d(data.X, dm)
+    y0 = logd[rows, idx - 1]
+    y1 = logd[rows, idx]
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        frac = np.where(y1 > y0, (logv - y0) / (y1 - y0), 0.0)
+    r = 10.0**(logr[idx - 1] + frac * (logr[idx] - logr[idx - 1]))
 
-        # calculate mass fractions
+    outside = (logv < logd[:, :1]) | (logv > logd[:, -1:])
+    r[outside] = np.nan
 
-        abar = 1.0 / np.sum(sdata.X / data.A[:,None], axis = 0)
-        zbar = abar *  np.sum(data.Z[:,None] / data.A[:,None] * 
-                              sdata.X , axis = 0)
-        sdata.abar = abar
-        sdata.zbar = zbar
+    return r.reshape(lead + (-1,))
 
-    else:
+class Shape:
+    """Isodensity surfaces r(theta) of a dump, from shape_profile"""
+    pass
 
-        if data.A is not None:
+def shape_profile(data, levels):
+    """Shape of the isodensity surfaces for each density level
 
-            abar = data.A
-            zbar = data.Z
-            
+    Returns a Shape with the levels, the polar angles x2, the radii r
+    of shape (angles..., nlev) for every ray of a 2D or 3D grid, and the
+    axis ratio (equatorial over polar radius) per level.  In 3D the
+    polar and equatorial radii are averaged over x3.
+    """
+
+    shape = Shape()
+    shape.levels = np.asarray(levels)
+    shape.x2 = data.x2
+    shape.r = isodensity(data.x1, data.d, levels)
+
+    pole = np.argmin(np.abs(data.x2))
+    equator = np.argmin(np.abs(data.x2 - 0.5 * np.pi))
+
+    # (..., nj, nlev): average any x3 axis away
+    r = shape.r if shape.r.ndim == 2 else np.mean(shape.r, axis = 0)
+    with np.errstate(invalid = "ignore"):
+        shape.ratio = r[equator] / r[pole]
+
+    return shape
+
+def _aspect(x1, dpole, dequator):
+
+    # aspect ratio is useful for determining the final state
+    rpole = isodensity(x1, dpole, dequator)
+    with np.errstate(invalid = "ignore"):
+        return np.nan_to_num(np.exp(np.log10(x1) - np.log10(rpole)))
+
+def _read_slab(data, alias, nr, **region):
+    # read part of a field and view it as (nang, nr), or (nspec, nang, nr)
+    raw = data._read_region(alias, np.float64, **region)
+    if alias == "X":
+        return raw.reshape(raw.shape[0], -1, nr)
+    return raw.reshape(-1, nr)
+
+def _oned_streamed(data, geom, profiles, nslab):
+    """Accumulate the weighted sums slab by slab straight from the file
+
+    Slabs are nslab planes of the outermost angular axis (k in 3D, j in
+    2D), so at most one slab of each needed field is in memory at once.
+    They are read through data's own file (so a ZeusStoreData reads its
+    dump of the store).
+    """
+
+    needs = _needs(profiles)
+
+    axis = "k" if geom.ndim == 3 else "j"
+    nplanes = geom.shape[0]
+    inner = int(np.prod(geom.shape[1:-1]))
+
+    aliases = ["d"] + [alias for alias in ("e", "T", "v3", "v1", "X")
+                       if needs[alias] and data._has(alias)]
+
+    sums = {}
+    for start in range(0, nplanes, nslab):
+        stop = min(start + nslab, nplanes)
+        region = {axis: slice(start, stop)}
+        fields = dict((alias, _read_slab(data, alias, geom.nr, **region))
+                      for alias in aliases)
+        rows = slice(start * inner, stop * inner)
+        for key, value in _weighted_sums(geom, fields, profiles, rows).items():
+            sums[key] = value if key not in sums else sums[key] + value
+        del fields
+
+    if "aspect" in profiles and geom.ndim == 2:
+        aspect = _aspect(data.x1,
+                         _read_slab(data, "d", geom.nr, j = 0)[0],
+                         _read_slab(data, "d", geom.nr, j = geom.shape[0] - 1)[0])
+    else:
+        aspect = None
+
+    return sums, aspect
+
+def oned(data, profiles = all_profiles, geometry = None, nslab = None,
+         eos = True, block = None, memory_report = False):
+    """Reduce a ZeusData of any dimensionality to radial profiles
+
+    profiles selects which of all_profiles to compute ("T" also gives
+    the entropy and pressure from the EOS).  Volume-weighted averages
+    are used for d and e, mass-weighted ones for everything else.
+    geometry is a GeometryCache (geometry_cache by default) or an
+    explicit _Geometry for this grid.
+
+    With nslab set, the fields are not loaded whole: they are streamed
+    from data's file nslab k-planes (j-planes in 2D) at a time and only
+    running radial sums are kept.
+
+    With block set, the in-memory fields are reduced block angular rows
+    at a time through reused float64 buffers, so float32 fields (see
+    ZeusData's dtype) are accumulated in float64 without ever being
+    upcast whole.  Streamed reads are always converted to float64.
+
+    With eos = False the EOS is not called: the profile keeps its
+    mass-weighted temperature guess as tguess, and T, s and P can be
+    filled in later for many dumps at once with apply_eos.
+
+    memory_report traces allocations and records the peak number of
+    bytes allocated while flattening as peak_bytes (this does not count
+    fields already loaded in data).
+    """
+
+    profiles = set(profiles)
+    needs = _needs(profiles)
+
+    if nslab is not None:
+        # slabs are read through the data object's own file
+        if not isinstance(data, ZeusData):
+            raise TypeError("streamed flattening needs a ZeusData, not {}".format(type(data).__name__))
+        if data.region:
+            raise ValueError("streamed flattening needs the full grid")
+
+    if geometry is None:
+        geometry = geometry_cache
+    if isinstance(geometry, GeometryCache):
+        geom = geometry.get(data)
+    else:
+        geom = geometry
+
+    if memory_report:
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
         else:
-            # assume CO
-            abar = 96.0/7.0
-            zbar = 48.0/7.0
+            tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
 
-        sdata.abar = abar * np.ones_like(data.x1)
-        sdata.zbar = zbar * np.ones_like(data.x1)
+    if nslab is not None:
+        sums, aspect = _oned_streamed(data, geom, profiles, nslab)
+    else:
+        fields = {"d": geom.flat(data.d)}
+        for alias in ("e", "T", "v3", "v1", "X"):
+            if needs[alias]:
+                fields[alias] = geom.flat(getattr(data, alias))
 
-    # guess for temp
-    tguess = weightedavg_3d(data.T, dm)
+        if block is not None:
+            sums = _blocked_sums(geom, fields, profiles, block)
+        else:
+            sums = _weighted_sums(geom, fields, profiles)
 
-    # call eos to derive temperature, entropy, etc
-    H = helmholtz.helmeos_DE(sdata.d, sdata.e, abar, zbar, tguess = tguess) 
+        if "aspect" in profiles and geom.ndim == 2:
+            aspect = _aspect(data.x1, data.d[0,:], data.d[-1,:])
+        else:
+            aspect = None
 
-    # put eos results
-    sdata.T = H.temp
-    sdata.s = H.stot
+    sdata = _profiles(geom, sums, data.A, data.Z, profiles, eos)
+    sdata.t = getattr(data, "t", None)
 
-    # rotation data, taken from the equator
+    if aspect is not None:
+        sdata.aspect = aspect
 
-    sdata.v3 = weightedavg_3d(data.v3, dm)
-    sdata.omega = sdata.v3 / sdata.r
-    sdata.j  = weightedavg_3d(RR * data.v3, dm)
+    if memory_report:
+        sdata.peak_bytes = tracemalloc.get_traced_memory()[1] - base
+        if not tracing:
+            tracemalloc.stop()
 
-    # mass loss rate through outer boundary
-    sdata.mdot = np.sum(np.sum(data.d * data.v1, axis = 0),axis=0) * data.x1**2
+    return sdata
 
-    # aspect ratio is useful for determining the final state
-    pole = 0
-    equator = -1
+def angular_profiles(data, edges, profiles = all_profiles, geometry = None,
+                     nslab = None, eos = True):
+    """Radial profiles in each of a set of polar-angle wedges
+
+    edges are bin edges in x2 (radians); a cell belongs to wedge b if
+    edges[b] <= x2 < edges[b+1], and cells outside all wedges are
+    ignored.  This is oned with the wedge weights of _Geometry.wedges,
+    so every profile is computed for every wedge in the same
+    contractions, and the result is a OneD whose profiles have shape
+    (wedge, radius) (X is (species, wedge, radius)).  Averages are
+    weighted as in oned; menc is the mass enclosed within each wedge and
+    mdot the outflow through it.  Empty wedges are NaN and are left out
+    of the EOS call.  The aspect ratio is a whole-grid quantity and is
+    not computed here.
+    """
+
+    if geometry is None:
+        geometry = geometry_cache
+    if isinstance(geometry, GeometryCache):
+        geom = geometry.get(data)
+    else:
+        geom = geometry
+
+    sdata = oned(data, set(profiles) - {"aspect"}, geom.wedges(edges), nslab, eos)
+    sdata.edges = np.asarray(edges, dtype = np.float64)
 
     return sdata
+
+def twod_to_oned(data, geometry = None):
+    return oned(data, geometry = geometry)
+
+def threed_to_oned(data, geometry = None, nslab = None):
+    return oned(data, geometry = geometry, nslab = nslab)
+
+
+# per-dump quantities collected by flatten_run, in OneD.write order
+series_quantities = ("r", "menc", "d", "e", "T", "s", "j", "omega",
+                     "abar", "zbar", "aspect", "mdot", "X")
+
+class EOSStats:
+    """Number of points, and time spent, in each EOS call of apply_eos"""
+
+    def __init__(self):
+        self.batches = []
+
+    def add(self, npoints, elapsed):
+        self.batches.append((npoints, elapsed))
+
+    @property
+    def ncalls(self):
+        return len(self.batches)
+
+    @property
+    def npoints(self):
+        return sum(n for n, _ in self.batches)
+
+    @property
+    def elapsed(self):
+        return sum(t for _, t in self.batches)
+
+    def show(self):
+        for n, (npoints, elapsed) in enumerate(self.batches):
+            print("  EOS batch {:4d}: {:8d} points  {:8.3f} s".format(n, npoints, elapsed))
+        print("  EOS total: {:d} calls, {:d} points, {:8.3f} s".format(
+            self.ncalls, self.npoints, self.elapsed))
+
+def apply_eos(profiles, batch = None, warm_start = False):
+    """Call the EOS for OneD profiles that were flattened with eos = False
+
+    The (d, e, abar, zbar) profiles of batch dumps at a time (all of
+    them by default) are stacked into one vectorized helmeos_DE call.
+    With warm_start the dumps are instead solved in order, each starting
+    from the previous dump's converged temperature rather than from its
+    own mass-weighted guess.  Fills in T, s and P on every profile and
+    returns an EOSStats.
+    """
+
+    stats = EOSStats()
+
+    def _solve(chunk, tguesses):
+        start = time.time()
+
+        # profiles may be (radius,) or, from angular_profiles, (wedge,
+        # radius); solve them all as one flat batch
+        def _stack(values):
+            return np.concatenate([np.ravel(np.broadcast_to(v, p.d.shape))
+                                   for p, v in zip(chunk, values)])
+
+        d = _stack([p.d for p in chunk])
+        e = _stack([p.e for p in chunk])
+        abar = _stack([p.abar for p in chunk])
+        zbar = _stack([p.zbar for p in chunk])
+        tguess = _stack(tguesses)
+
+        # as in _profiles, points without mass (e.g. empty wedges) are
+        # left out of the EOS call and stay NaN
+        valid = (d > 0) & np.isfinite(d) & np.isfinite(e) & np.isfinite(tguess)
+        T, s, P = [np.full(d.shape, np.nan) for _ in range(3)]
+
+        H = helmholtz.helmeos_DE(d[valid], e[valid], abar[valid], zbar[valid],
+                                 tguess = tguess[valid])
+        T[valid] = H.temp
+        s[valid] = H.stot
+        P[valid] = H.ptot
+
+        bounds = np.cumsum([0] + [p.d.size for p in chunk])
+        for p, lo, hi in zip(chunk, bounds[:-1], bounds[1:]):
+            p.T = T[lo:hi].reshape(p.d.shape)
+            p.s = s[lo:hi].reshape(p.d.shape)
+            p.P = P[lo:hi].reshape(p.d.shape)
+        stats.add(int(valid.sum()), time.time() - start)
+
+    if warm_start:
+        previous = None
+        for p in profiles:
+            if previous is not None and previous.T.shape == p.d.shape:
+                tguess = np.where(np.isfinite(previous.T), previous.T, p.tguess)
+            else:
+                tguess = p.tguess
+            _solve([p], [tguess])
+            previous = p
+    else:
+        batch = batch or max(len(profiles), 1)
+        for start in range(0, len(profiles), batch):
+            chunk = profiles[start:start+batch]
+            _solve(chunk, [p.tguess for p in chunk])
+
+    return stats
+
+
+def _flatten_dump(filename, eos = True):
+    # worker for flatten_run
+    with ZeusData(filename) as data:
+        return oned(data, eos = eos)
+
+def flatten_run(output, filename = None, nworkers = 1,
+                eos = "dump", eos_batch = None):
+    """Flatten every readable dump of a ZeusMPOutput into time x radius arrays
+
+    The dumps are flattened in a process pool of nworkers processes.
+    eos chooses how temperatures are found: "dump" calls the EOS once
+    per dump, "batch" stacks eos_batch dumps (default all) into each
+    EOS call and "warm" warm-starts each dump from the previous one
+    (see apply_eos).
+
+    Returns an OrderedDict with the dump times under "t" and, for each
+    of series_quantities that every profile has, an array of shape
+    (time, radius) (X is (time, species, radius)).  If filename is
+    given the arrays are also written there as a series file (see
+    write_series), to which later dumps can be appended.
+    """
+
+    if eos not in ("dump", "batch", "warm"):
+        raise ValueError("unknown eos mode {}".format(eos))
+
+    worker = functools.partial(_flatten_dump, eos = (eos == "dump"))
+    files = output.dumps
+
+    if nworkers > 1:
+        with concurrent.futures.ProcessPoolExecutor(nworkers) as executor:
+            profiles = list(executor.map(worker, files))
+    else:
+        profiles = [worker(f) for f in files]
+
+    if eos != "dump":
+        apply_eos(profiles, batch = eos_batch, warm_start = (eos == "warm"))
+
+    series = OrderedDict()
+    series["t"] = np.array([float(p.t) for p in profiles])
+    for q in series_quantities:
+        if profiles and all(hasattr(p, q) for p in profiles):
+            series[q] = np.array([getattr(p, q) for p in profiles])
+
+    if filename is not None:
+        write_series(filename, series, files)
+
+    return series
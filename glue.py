@@ -0,0 +1,146 @@
+import concurrent.futures
+import glob
+import numpy as np
+import os
+import re
+
+from .output import ZeusFile, _readable, dset_aliases, dset_axes
+
+
+# per-rank tiles are hdfaa<6-digit tile id>.<dump>, glued dumps hdfaa.<dump>
+tile_pattern = re.compile(r"hdfaa(\d{6})\.(\d{3})$")
+
+
+def tile_files(datadir, dump):
+    """Sorted per-rank tile files of one dump"""
+
+    return sorted(glob.glob(os.path.join(datadir, "hdfaa??????.{:03d}".format(dump))))
+
+def tile_dumps(datadir):
+    """Dump numbers that have at least one tile, with their tile counts"""
+
+    counts = {}
+    for path in glob.glob(os.path.join(datadir, "hdfaa??????.???")):
+        match = tile_pattern.match(os.path.basename(path))
+        if match:
+            dump = int(match.group(2))
+            counts[dump] = counts.get(dump, 0) + 1
+
+    return dict(sorted(counts.items()))
+
+def _global_coords(tiles):
+    # the zone centers of all tiles, merged, along each axis; tiles that
+    # share an axis (e.g. k in 2D) contribute the same coordinates
+    coords = {}
+    for alias in ("x1", "x2", "x3"):
+        coords[alias] = np.unique(np.concatenate([tile.get_dset(alias) for tile in tiles]))
+    return coords
+
+def _placement(tile, coords):
+    # offset of the tile along i, j and k in the global grid
+    offsets = {}
+    for alias, axis in (("x1", "i"), ("x2", "j"), ("x3", "k")):
+        c = tile.get_dset(alias)
+        start = int(np.searchsorted(coords[alias], c[0]))
+        if not np.array_equal(coords[alias][start:start + c.size], c):
+            raise ValueError("{} of {} does not lie on the global grid".format(alias, tile.filename))
+        offsets[axis] = slice(start, start + c.size)
+    return offsets
+
+def glue_dump(datadir, dump, outdir = None):
+    """Assemble the per-rank tiles of one dump into hdfaa.<dump>
+
+    Each tile is placed by locating its coordinates in the merged global
+    coordinates, and its fields are written straight into the matching
+    hyperslab of the output, so each output dataset is written once.
+    The dump is written to a temporary name and renamed into place when
+    complete, so readers never see a partial file.  Returns the name of
+    the glued dump.
+    """
+
+    outdir = datadir if outdir is None else outdir
+    filename = os.path.join(outdir, "hdfaa.{:03d}".format(dump))
+    partial = filename + ".partial"
+
+    names = tile_files(datadir, dump)
+    if not names:
+        raise IOError("no tiles for dump {} in {}".format(dump, datadir))
+
+    tiles = [ZeusFile(name, "r") for name in names]
+    try:
+        coords = _global_coords(tiles)
+        offsets = [_placement(tile, coords) for tile in tiles]
+        axis_dsets = dict((dset_aliases[alias], axis) for alias, axis in dset_axes.items())
+        shape = dict((axis, coords[alias].size) for alias, axis in (("x1", "i"), ("x2", "j"), ("x3", "k")))
+
+        with ZeusFile(partial, "w") as out:
+            for name, dset in tiles[0].items():
+                if name in axis_dsets:
+                    # coordinates and volume elements, pieced together along their axis
+                    axis = axis_dsets[name]
+                    glued = out.create_dataset(name, (shape[axis],), dtype = dset.dtype)
+                    for tile, off in zip(tiles, offsets):
+                        glued[off[axis]] = tile[name][()]
+                elif dset.ndim >= 3:
+                    # fields are stored (..., k, j, i)
+                    glued = out.create_dataset(name, dset.shape[:-3] + (shape["k"], shape["j"], shape["i"]),
+                                               dtype = dset.dtype)
+                    for tile, off in zip(tiles, offsets):
+                        glued[..., off["k"], off["j"], off["i"]] = tile[name][()]
+                else:
+                    # time, species data and the like are the same in every tile
+                    glued = out.create_dataset(name, data = dset[()])
+                for key, value in dset.attrs.items():
+                    glued.attrs[key] = value
+    finally:
+        for tile in tiles:
+            tile.close()
+
+    os.replace(partial, filename)
+
+    return filename
+
+def _glue_task(args):
+    datadir, dump, outdir = args
+    return glue_dump(datadir, dump, outdir)
+
+def glue_output(datadir = "./", first = None, last = None, outdir = None,
+                nworkers = 1, overwrite = False):
+    """Glue every complete dump in [first, last] and return the new files
+
+    A dump is glued once it has as many tiles as the dump with the most
+    tiles and all of them are readable, so this can be called
+    repeatedly while the simulation is still writing.  Dumps that are
+    already glued, and not older than their tiles, are skipped unless
+    overwrite is set.  With nworkers > 1 the dumps are glued
+    concurrently in a process pool.
+    """
+
+    outdir = datadir if outdir is None else outdir
+    counts = tile_dumps(datadir)
+    if not counts:
+        return []
+    ntiles = max(counts.values())
+
+    todo = []
+    for dump, count in counts.items():
+        if (first is not None and dump < first) or (last is not None and dump > last):
+            continue
+        if count < ntiles:
+            continue
+        names = tile_files(datadir, dump)
+        if not all(_readable(name) for name in names):
+            continue
+        glued = os.path.join(outdir, "hdfaa.{:03d}".format(dump))
+        if (not overwrite and os.path.exists(glued) and
+            os.path.getmtime(glued) >= max(os.path.getmtime(name) for name in names)):
+            continue
+        todo.append(dump)
+
+    tasks = [(datadir, dump, outdir) for dump in todo]
+
+    if nworkers <= 1:
+        return [_glue_task(task) for task in tasks]
+
+    with concurrent.futures.ProcessPoolExecutor(nworkers) as executor:
+        return list(executor.map(_glue_task, tasks))
@@ -1,44 +1,84 @@
 import numpy as np
+import os
+
+def solve_xrat(npts, dxmin, xmin = 0, xmax = 1, tol = 1e-14):
+    """Ratio xrat that gives a RatioedGrid the zone width dxmin
+
+    dxmin is the width of the first zone for igrid = 1 and of the last
+    zone for igrid = -1; both lead to the same xrat.  All arguments
+    broadcast, so many grid specifications can be solved at once.
+    Specifications with no solution (npts < 2, or dxmin not between 0
+    and xmax - xmin) give NaN.
+    """
+
+    npts, dxmin, xmin, xmax = np.broadcast_arrays(np.asarray(npts, dtype = np.float64),
+                                                  np.asarray(dxmin, dtype = np.float64),
+                                                  np.asarray(xmin, dtype = np.float64),
+                                                  np.asarray(xmax, dtype = np.float64))
+    target = dxmin / (xmax - xmin)
+
+    # the first zone is expm1(s)/expm1(npts s) of the interval, where
+    # s = log(xrat); this falls monotonically from 1 to 0, so bisect in s
+    def fraction(s):
+        with np.errstate(over = "ignore", divide = "ignore", invalid = "ignore"):
+            f = np.expm1(s) / np.expm1(npts * s)
+        return np.where(s == 0, 1.0 / npts, np.nan_to_num(f))
+
+    lo = np.full(target.shape, -50.0)
+    hi = np.full(target.shape, 50.0)
+    while np.any(hi - lo > tol):
+        mid = 0.5 * (lo + hi)
+        above = fraction(mid) > target
+        lo = np.where(above, mid, lo)
+        hi = np.where(above, hi, mid)
+
+    xrat = np.exp(0.5 * (lo + hi))
+    bad = (npts < 2) | ~(target > 0) | ~(target < 1)
+    xrat = np.where(bad, np.nan, xrat)
+
+    return xrat if xrat.ndim else xrat.item()
+
 
 class RatioedGrid:
     
-    def __init__(self, npts, xmin = 0, xmax = 1, xrat = 1, igrid = 1):
-        self.npts = np.cast['int32'](npts)
-        self.igrid = np.cast['int32'](igrid)
+    def __init__(self, npts, xmin = 0, xmax = 1, xrat = 1, igrid = 1, dxmin = None):
+        self.npts = np.int32(npts)
+        self.igrid = np.int32(igrid)
+
+        self.xmin = np.float64(xmin)
+        self.xmax = np.float64(xmax)
 
-        self.xmin = np.cast['float64'](xmin)
-        self.xmax = np.cast['float64'](xmax)
-        self.xrat = np.cast['float64'](xrat)
+        if dxmin is not None:
+            xrat = solve_xrat(npts, dxmin, xmin, xmax)
+            if np.isnan(xrat):
+                raise ValueError("no ratioed grid of {} zones on [{}, {}] has dxmin = {}".format(npts, xmin, xmax, dxmin))
+        self.xrat = np.float64(xrat)
 
         self._make_grid()
 
     def _make_grid(self):
-        
-        xagrid = np.empty(self.npts, dtype = np.float64)
-        xbgrid = np.empty(self.npts, dtype = np.float64)
-        dxgrid = np.empty(self.npts, dtype = np.float64)
-
-        xagrid[0] = self.xmin
 
         if (self.igrid == -1):
             xrat = 1.0/self.xrat
         elif(self.igrid == 1):
             xrat = self.xrat
 
+        # zone widths grow geometrically, and the faces are their running sum
         if (xrat == 1.0):
-            dxgrid[0] = (self.xmax-self.xmin)/np.cast['float64'](self.npts)
+            dxgrid = np.full(self.npts, (self.xmax-self.xmin)/np.float64(self.npts))
         else:
-            dxgrid[0] = (self.xmax-self.xmin)*(xrat-1.0)/(xrat**self.npts - 1.0)
-            
-        for i in range(1,self.npts):
-            dxgrid[i] = dxgrid[i-1] * xrat
-            xagrid[i] =  xagrid[i-1] + dxgrid[i-1]
+            # (xrat - 1)/(xrat**npts - 1), kept accurate for xrat near 1
+            s = np.log(xrat)
+            dx0 = (self.xmax-self.xmin)*np.expm1(s)/np.expm1(self.npts*s)
+            dxgrid = dx0 * xrat**np.arange(self.npts, dtype = np.float64)
+
+        xagrid = np.cumsum(np.concatenate(([self.xmin], dxgrid[:-1])))
 
-        for i in range(self.npts):
-            xbgrid[i] = xagrid[i] + 0.5*dxgrid[i]
+        xbgrid = xagrid + 0.5*dxgrid
 
         self._agrid = xagrid
         self._bgrid = xbgrid
+        self._dgrid = dxgrid
         
         return
 
@@ -46,99 +86,320 @@ class RatioedGrid:
         return self._agrid
     def bgrid(self):
         return self._bgrid
+    def dgrid(self):
+        return self._dgrid
 
 
 
-class ZeusTile:
-    
-    def __init__(self,filename):
+def read_tile_columns(filename):
+    """Parse a tile grid file into its header and five columns
 
-        self._read_tile(filename)
-        self._compute_cartesian_grids()
+    Returns ((ni, nj, nk), idx, a, b, vla, vlb), where the columns run
+    over the i, then j, then k zones.  The whole body is handed to
+    numpy's whitespace parser in one call, which is far quicker than
+    genfromtxt on these fixed-format files.
+    """
 
-        return
+    with open(filename, "r") as tilefile:
+        text = tilefile.read()
+
+    values = np.fromstring(text, dtype = np.float64, sep = " ")
+    if values.size < 3 or (values.size - 3) % 5:
+        raise ValueError("{} is not a tile grid file".format(filename))
 
-    def _read_tile(self, filename):
+    # this is reversed from the fortran b/c in is a reserved word
+    ni, nj, nk = values[:3].astype("int32")
+    columns = values[3:].reshape(-1, 5)
 
-        with open(filename, "r") as tilefile:
-            # this is reversed from the fortran b/c in is a reserved word
-            self.ni, self.nj, self.nk = np.fromfile(tilefile, dtype="int32", 
-                                                    count = 3, sep = " ")
+    return ((ni, nj, nk), columns[:,0].astype("int32"),
+            columns[:,1].copy(), columns[:,2].copy(),
+            columns[:,3].copy(), columns[:,4].copy())
 
-            raw_data= np.genfromtxt(tilefile, 
-                                    dtype = ("int32", "float64", "float64", "float64", "float64"),
-                                    names = ("idx", "a", "b", "vla", "vlb"))
 
-            self.ii, self.ij, self.ik = np.split(raw_data["idx"],
-                                                 [self.ni,
-                                                  self.ni+self.nj])
+class ZeusTile:
+    
+    # Cartesian grids, built on first access: (coordinate, radial
+    # centering, polar centering), where b is zone centered and a is face
+    # centered
+    _cartesian = {"xbb": ("x", "b", "b"), "ybb": ("y", "b", "b"), "zbb": ("z", "b", "b"),
+                  "xab": ("x", "a", "b"), "yab": ("y", "a", "b"), "zab": ("z", "a", "b"),
+                  "xba": ("x", "b", "a"), "yba": ("y", "b", "a"), "zba": ("z", "b", "a")}
+
+    def __init__(self, filename, cache = False, nphi = 2):
 
-            self.x1a, self.x2a, self.x3a = np.split(raw_data["a"],
-                                                    [self.ni,
-                                                     self.ni+self.nj])
+        self._read_tile(filename, cache)
+        self._compute_cartesian_grids(nphi)
 
-            self.x1b, self.x2b, self.x3b = np.split(raw_data["b"],
-                                                    [self.ni,
-                                                     self.ni+self.nj])
+        return
 
-            self.vl1a, self.vl2a, self.vl3a = np.split(raw_data["vla"],
-                                                    [self.ni,
-                                                     self.ni+self.nj])
+    def _read_tile(self, filename, cache = False):
+        """Read the tile grid, preferring a binary sidecar if it exists
+
+        The sidecar (the tile name with .npz appended) is only trusted
+        while the tile's size and mtime are unchanged.  If cache is set,
+        a stale or missing sidecar is rewritten after parsing.
+        """
+
+        sidecar = filename + ".npz"
+        st = os.stat(filename)
+        stamp = np.array([st.st_size, st.st_mtime])
+
+        try:
+            with np.load(sidecar) as stored:
+                if not np.array_equal(stored["stamp"], stamp):
+                    raise ValueError("stale sidecar")
+                header = tuple(stored["header"])
+                idx, a, b, vla, vlb = [stored[col] for col in ("idx", "a", "b", "vla", "vlb")]
+        except (IOError, OSError, ValueError, KeyError):
+            header, idx, a, b, vla, vlb = read_tile_columns(filename)
+            if cache:
+                try:
+                    with open(sidecar, "wb") as f:
+                        np.savez(f, stamp = stamp, header = np.array(header),
+                                 idx = idx, a = a, b = b, vla = vla, vlb = vlb)
+                except (IOError, OSError):
+                    pass
+
+        self.ni, self.nj, self.nk = header
+
+        splits = [self.ni, self.ni+self.nj]
+
+        self.ii, self.ij, self.ik = np.split(idx, splits)
+        self.x1a, self.x2a, self.x3a = np.split(a, splits)
+        self.x1b, self.x2b, self.x3b = np.split(b, splits)
+        self.vl1a, self.vl2a, self.vl3a = np.split(vla, splits)
+        self.vl1b, self.vl2b, self.vl3b = np.split(vlb, splits)
 
-            self.vl1b, self.vl2b, self.vl3b = np.split(raw_data["vlb"],
-                                                    [self.ni,
-                                                     self.ni+self.nj])
+        return
 
+    def _compute_cartesian_grids(self, nphi = 2):
+        """Set up the azimuthal grid used to sweep the tile into 3D
 
-            return
+        The Cartesian grids themselves (xbb, ..., zba) are only built
+        when first accessed.
+        """
 
-    def _compute_cartesian_grids(self):
-        
-        nphi = 2
-        phi_grid = RatioedGrid(npts = nphi, xmin = 0, xmax = 2*np.pi, xrat = 1).bgrid()
+        self.phi = RatioedGrid(npts = nphi, xmin = 0, xmax = 2*np.pi, xrat = 1).bgrid()
         self.nk = nphi
         self.vl3 = 2.0 * np.pi / nphi
 
-        # define things on bbb grid
+        for name in self._cartesian:
+            self.__dict__.pop(name, None)
+
+        return
+
+    def cartesian_factors(self, radial = "b", polar = "b"):
+        """Broadcastable factors of the Cartesian coordinates
+
+        Returns (r, sin(theta), cos(theta), cos(phi), sin(phi)) shaped
+        (ni,1,1), (1,nj,1), (1,nj,1), (1,1,nk), (1,1,nk), so that
+        x = r * sin(theta) * cos(phi) and so on.  radial and polar pick
+        zone centers ("b") or faces ("a").  Index the factors before
+        multiplying to get coordinates for part of the tile.
+        """
+
+        r = getattr(self, "x1" + radial)[:,None,None]
+        theta = getattr(self, "x2" + polar)[None,:,None]
+        phi = self.phi[None,None,:]
+
+        return r, np.sin(theta), np.cos(theta), np.cos(phi), np.sin(phi)
+
+    def cartesian(self, coord, radial = "b", polar = "b", i = slice(None), j = slice(None), k = slice(None)):
+        """One Cartesian coordinate ("x", "y" or "z") over part of the tile"""
+
+        r, sint, cost, cosp, sinp = self.cartesian_factors(radial, polar)
+        r, sint, cost = r[i,:,:], sint[:,j,:], cost[:,j,:]
+        cosp, sinp = cosp[:,:,k], sinp[:,:,k]
+
+        if coord == "x":
+            return r * sint * cosp
+        elif coord == "y":
+            return r * sint * sinp
+        elif coord == "z":
+            return r * cost * np.ones_like(cosp)
+        raise ValueError("unknown coordinate {}".format(coord))
+
+    def __getattr__(self, name):
+        try:
+            coord, radial, polar = self._cartesian[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = self.cartesian(coord, radial, polar)
+        setattr(self, name, value)
+        return value
+
+
+def cartesian_to_spherical(x, y, z):
+    """(r, theta, phi) of Cartesian points, with phi in [0, 2 pi)"""
+
+    x, y, z = np.broadcast_arrays(np.asarray(x, dtype = np.float64),
+                                  np.asarray(y, dtype = np.float64),
+                                  np.asarray(z, dtype = np.float64))
+    r = np.sqrt(x*x + y*y + z*z)
+    theta = np.arctan2(np.hypot(x, y), z)
+    phi = np.mod(np.arctan2(y, x), 2*np.pi)
+
+    return r, theta, phi
+
+
+class Stencil:
+    """Cells and weights that sample fields at a fixed set of points
+
+    index holds, for every point, the flat (k, j, i) indices of the
+    cells it draws on and weights their weights.  Points outside the
+    grid are marked False in inside.  A stencil depends only on the grid
+    and the points, so it can be applied to any field of any dump on the
+    same grid.
+    """
+
+    def __init__(self, index, weights, inside, shape, grid_shape):
+        self.index = index
+        self.weights = weights
+        self.inside = inside
+        self.shape = shape
+        self.grid_shape = grid_shape
+
+    def apply(self, field, fill = np.nan):
+        """Sample a (..., k, j, i) field; returns (..., *points shape)"""
+
+        field = np.asarray(field)
+
+        # the trailing axes hold the grid (k may be dropped in 2D), any
+        # leading ones (e.g. species) are carried through
+        ncell = int(np.prod(self.grid_shape))
+        ntrail = next((n for n in range(field.ndim + 1)
+                       if int(np.prod(field.shape[field.ndim - n:])) == ncell), None)
+        if ntrail is None:
+            raise ValueError("field shape {} does not match grid {}".format(field.shape, self.grid_shape))
+        lead = field.shape[:field.ndim - ntrail]
+        flat = field.reshape(lead + (ncell,))
+
+        values = np.einsum("...pc,pc->...p", flat[..., self.index], self.weights)
+        values = np.where(self.inside.ravel(), values, fill)
+
+        return values.reshape(lead + self.shape)
+
+
+class GridLocator:
+    """Map points on a spherical ZEUS grid to cells and interpolation weights
+
+    x1, x2 and x3 are the zone centers (x3 may be omitted in 2D); x1a,
+    x2a and x3a are the left zone faces, and if they are not given the
+    faces are put midway between the centers.  Points whose coordinates
+    fall outside the outer faces are outside the grid.  With periodic3
+    the azimuthal axis wraps around 2 pi.
+    """
+
+    def __init__(self, x1, x2, x3 = None, x1a = None, x2a = None, x3a = None,
+                 periodic3 = False):
+
+        x3 = np.zeros(1) if x3 is None else x3
+        self.centers = [np.asarray(x, dtype = np.float64) for x in (x1, x2, x3)]
+        self.faces = [self._faces(c, a) for c, a in zip(self.centers, (x1a, x2a, x3a))]
+        self.periodic3 = periodic3
+        # fields are stored (k, j, i)
+        self.grid_shape = tuple(c.size for c in self.centers[::-1])
+
+    @classmethod
+    def from_data(cls, data, periodic3 = False):
+        """Locator on the grid of a ZeusData"""
+        return cls(data.x1, data.x2, data.x3, periodic3 = periodic3)
+
+    @classmethod
+    def from_tile(cls, tile, periodic3 = True):
+        """Locator on the swept grid of a ZeusTile
+
+        The azimuthal axis is the tile's nphi zones of phi (see
+        ZeusTile(nphi = ...)), matching its Cartesian grids, and wraps
+        around 2 pi by default.  Those grids are stored (i, j, k), so
+        transpose them (e.g. tile.xbb.T) to sample them with a stencil.
+        """
+        return cls(tile.x1b, tile.x2b, tile.phi, tile.x1a, tile.x2a,
+                   tile.phi - 0.5 * tile.vl3, periodic3 = periodic3)
+
+    @staticmethod
+    def _faces(c, a):
+        # left faces plus the outer right face; a single zone (e.g. the k
+        # axis in 2D) covers everything
+        if c.size == 1:
+            return np.array([-np.inf, np.inf])
+        if a is not None:
+            a = np.asarray(a, dtype = np.float64)
+            return np.append(a, 2*c[-1] - a[-1])
+        mid = 0.5 * (c[1:] + c[:-1])
+        return np.concatenate(([c[0] - (mid[0] - c[0])], mid, [c[-1] + (c[-1] - mid[-1])]))
+
+    def _axis(self, n, p, method):
+        # cells and weights along one axis: nearest gives one cell per
+        # point, linear the two centers that bracket it (clamped at the
+        # ends, where the nearer center gets all the weight)
+        c, f = self.centers[n], self.faces[n]
+        size = c.size
+        periodic = n == 2 and self.periodic3 and size > 1
+
+        if periodic:
+            p = f[0] + np.mod(p - f[0], 2*np.pi)
+            inside = np.ones(p.shape, dtype = bool)
+        else:
+            inside = (p >= f[0]) & (p <= f[-1])
 
-        self.xbb = (self.x1b[:,None,None] 
-                    * np.sin(self.x2b[None,:,None]) 
-                    * np.cos(phi_grid[None,None,:]))
+        if method == "nearest":
+            cell = np.clip(np.searchsorted(f, p, side = "right") - 1, 0, size - 1)
+            return cell[...,None], np.ones(p.shape + (1,)), inside
 
-        self.ybb = (self.x1b[:,None,None] 
-                    * np.sin(self.x2b[None,:,None])
-                    * np.sin(phi_grid[None,None,:]))
+        if size == 1:
+            return np.zeros(p.shape + (1,), dtype = np.intp), np.ones(p.shape + (1,)), inside
 
-        self.zbb = (self.x1b[:,None,None] 
-                    * np.cos(self.x2b[None,:,None])
-                    * np.ones(nphi)[None,None,:])
+        if periodic:
+            # centers extended by one period on each side
+            cc = np.concatenate(([c[-1] - 2*np.pi], c, [c[0] + 2*np.pi]))
+            lo = np.clip(np.searchsorted(cc, p, side = "right") - 1, 0, size)
+            w = (p - cc[lo]) / (cc[lo + 1] - cc[lo])
+            cells = np.stack([np.mod(lo - 1, size), np.mod(lo, size)], axis = -1)
+        else:
+            lo = np.clip(np.searchsorted(c, p, side = "right") - 1, 0, size - 2)
+            w = np.clip((p - c[lo]) / (c[lo + 1] - c[lo]), 0.0, 1.0)
+            cells = np.stack([lo, lo + 1], axis = -1)
 
-        # define things on ab grid
+        return cells, np.stack([1.0 - w, w], axis = -1), inside
 
-        self.xab = (self.x1a[:,None,None] 
-                    * np.sin(self.x2b[None,:,None]) 
-                    * np.cos(phi_grid[None,None,:]))
+    def stencil(self, x1, x2, x3 = None, method = "linear", cartesian = False):
+        """Stencil sampling the grid at points
 
-        self.yab = (self.x1a[:,None,None] 
-                    * np.sin(self.x2b[None,:,None])
-                    * np.sin(phi_grid[None,None,:]))
+        The points are (r, theta, phi), or (x, y, z) if cartesian is set,
+        as broadcastable arrays; x3 may be omitted in 2D.  method is
+        "nearest" (the cell containing each point) or "linear" (linear
+        along each axis with more than one zone, i.e. bi- or trilinear).
+        """
 
-        self.zab = (self.x1a[:,None,None] 
-                    * np.cos(self.x2b[None,:,None])
-                    * np.ones(nphi)[None,None,:])
+        if method not in ("nearest", "linear"):
+            raise ValueError("unknown method {}".format(method))
 
-        # define things on ba grid
+        if cartesian:
+            x1, x2, x3 = cartesian_to_spherical(x1, x2, 0.0 if x3 is None else x3)
+        x3 = 0.0 if x3 is None else x3
+        points = np.broadcast_arrays(*[np.asarray(x, dtype = np.float64) for x in (x1, x2, x3)])
+        shape = points[0].shape
+        points = [p.ravel() for p in points]
 
-        self.xba = (self.x1b[:,None,None] 
-                    * np.sin(self.x2a[None,:,None]) 
-                    * np.cos(phi_grid[None,None,:]))
+        ni, nj = self.centers[0].size, self.centers[1].size
+        (ci, wi, ini), (cj, wj, inj), (ck, wk, ink) = [self._axis(n, points[n], method) for n in range(3)]
 
-        self.yba = (self.x1b[:,None,None] 
-                    * np.sin(self.x2a[None,:,None])
-                    * np.sin(phi_grid[None,None,:]))
+        # all combinations of the per-axis cells, as flat (k, j, i) indices
+        npts = points[0].size
+        index = ((ck[:,:,None,None] * nj + cj[:,None,:,None]) * ni + ci[:,None,None,:]).reshape(npts, -1)
+        weights = (wk[:,:,None,None] * wj[:,None,:,None] * wi[:,None,None,:]).reshape(npts, -1)
 
-        self.zba = (self.x1b[:,None,None] 
-                    * np.cos(self.x2a[None,:,None])
-                    * np.ones(nphi)[None,None,:])
+        return Stencil(index, weights, (ini & inj & ink).reshape(shape), shape, self.grid_shape)
 
-        return
+    def locate(self, x1, x2, x3 = None, cartesian = False):
+        """(i, j, k) indices of the cells containing points"""
+
+        flat = self.stencil(x1, x2, x3, method = "nearest", cartesian = cartesian)
+        k, j, i = np.unravel_index(flat.index[:,0], self.grid_shape)
+        return i.reshape(flat.shape), j.reshape(flat.shape), k.reshape(flat.shape)
+
+    def sample(self, field, x1, x2, x3 = None, method = "linear", cartesian = False, fill = np.nan):
+        """Sample one field at points; build a stencil to reuse the weights"""
+
+        return self.stencil(x1, x2, x3, method, cartesian).apply(field, fill)
@@ -1,7 +1,14 @@
+from collections import OrderedDict
+import concurrent.futures
 import glob
 import h5py
+import hashlib
+import io
+import json
 import numpy as np
 import os
+import sys
+import time
 
 
 # define map to the HDF5 datasets
@@ -28,26 +35,211 @@ dset_aliases = {"t" : "   time",
                 "X":  "abun"}
 
 
+# grid axis along which each one-dimensional alias runs
+dset_axes = {"x1": "i", "dV1": "i",
+             "x2": "j", "dV2": "j",
+             "x3": "k", "dV3": "k"}
+
+
 class ZeusFile(h5py.File):
 
-    def get_dset(self, name):
-        return self[dset_aliases[name]][:]
+    def selection(self, i = None, j = None, k = None,
+                  x1 = None, x2 = None, x3 = None):
+        """Turn index and coordinate bounds into a per-axis selection
+
+        i, j and k may each be an integer (a single plane) or a slice
+        (a range, optionally strided).  x1, x2 and x3 are (lo, hi)
+        coordinate bounds, inclusive, on the zone centers and are
+        converted to index ranges along i, j and k respectively.
+        """
+
+        sel = {"i": i, "j": j, "k": k}
+
+        for axis, coord, bounds in (("i", "x1", x1),
+                                    ("j", "x2", x2),
+                                    ("k", "x3", x3)):
+            if bounds is None:
+                continue
+            if sel[axis] is not None:
+                raise ValueError("cannot select on both {} and {}".format(axis, coord))
+            lo, hi = bounds
+            c = self.get_dset(coord)
+            sel[axis] = slice(int(np.searchsorted(c, lo, side = "left")),
+                              int(np.searchsorted(c, hi, side = "right")))
+
+        return sel
+
+    def _hyperslab(self, name, dset, sel):
+
+        def _axis(axis):
+            return slice(None) if sel[axis] is None else sel[axis]
+
+        if name in dset_axes:
+            return (_axis(dset_axes[name]),)
+        elif dset.ndim >= 3:
+            # fields are stored (..., k, j, i)
+            return (Ellipsis, _axis("k"), _axis("j"), _axis("i"))
+        else:
+            return Ellipsis
+
+    def volume(self, **region):
+        """Volume elements laid out like a (sub-region of a) field
+
+        The result has the shape that get_dset returns for a field
+        stored (k, j, i) with the same region keywords.
+        """
+
+        sel = self.selection(**region)
+
+        dV = (np.atleast_1d(self.get_dset("dV3", **region))[:,None,None] *
+              np.atleast_1d(self.get_dset("dV2", **region))[None,:,None] *
+              np.atleast_1d(self.get_dset("dV1", **region))[None,None,:])
+
+        # drop the axes that were selected with a single index
+        return dV[tuple(0 if isinstance(sel[axis], (int, np.integer)) else slice(None)
+                        for axis in ("k", "j", "i"))]
+
+    @staticmethod
+    def _cast(dset, dtype):
+        # only fields are converted; the grid keeps its full precision
+        if dtype is None or dset.ndim < 3:
+            return dset
+        return dset.astype(dtype)
+
+    def get_dset(self, name, dtype = None, **region):
+        """Read an aliased dataset, optionally restricted to a sub-region
+
+        The keywords are those of selection(); they are passed straight
+        to h5py so that only the requested hyperslab is read.  If dtype
+        is given, fields are converted to it by HDF5 as they are read.
+        """
+
+        dset = self[dset_aliases[name]]
+        sel = self.selection(**region) if region else None
+        dset = self._cast(dset, dtype)
+
+        if sel is None:
+            return dset[:]
+
+        return dset[self._hyperslab(name, self[dset_aliases[name]], sel)]
 
 class ZeusData:
-    
-    def __init__(self, filename):
-        with ZeusFile(filename) as zf:
-            for alias in dset_aliases.keys():
-                try:
-                    setattr(self, alias, np.squeeze(zf.get_dset(alias)))
-                except:
-                    setattr(self, alias, None)
+    """Lazily loaded view of a ZEUS-MP HDF5 dump
+
+    Each alias in dset_aliases is read from the file on first access and
+    kept in a least-recently-used cache.  Once the cached fields exceed
+    max_bytes, the oldest ones are evicted and will simply be read again
+    if they are needed later.  Datasets missing from the file are None.
+
+    Any region keywords (see ZeusFile.selection) restrict every field,
+    coordinate and volume element to that sub-region of the grid.  With
+    dtype set (e.g. np.float32), fields are converted as they are read.
+    """
+
+    def __init__(self, filename, max_bytes = 2**30, dtype = None, **region):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.region = region
+        self._zf = None
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        self._missing = set()
+
+    def __getattr__(self, alias):
+        if alias.startswith("_") or alias not in dset_aliases:
+            raise AttributeError(alias)
+        return self.load(alias)
+
+    def load(self, alias):
+        """Return the (squeezed) data for alias, reading it if needed"""
+
+        if alias in self._cache:
+            self._cache.move_to_end(alias)
+            return self._cache[alias]
+
+        if alias in self._missing:
+            return None
+
+        if self._zf is None:
+            self._zf = self._open()
+
+        try:
+            value = np.squeeze(self._read(alias))
+        except KeyError:
+            self._missing.add(alias)
+            return None
+
+        self._cache[alias] = value
+        self._nbytes += value.nbytes
+        self._evict(keep = alias)
+
+        return value
+
+    def _open(self):
+        return ZeusFile(self.filename, "r")
+
+    def _read(self, alias):
+        return self._zf.get_dset(alias, self.dtype, **self.region)
+
+    def _read_region(self, alias, dtype = None, **region):
+        # uncached hyperslab read of the whole-grid region, e.g. for streaming
+        if self._zf is None:
+            self._zf = self._open()
+        return self._zf.get_dset(alias, dtype, **region)
+
+    def _has(self, alias):
+        if self._zf is None:
+            self._zf = self._open()
+        return dset_aliases[alias] in self._zf
+
+    def _evict(self, keep = None):
+        # drop least recently used fields until we fit under max_bytes
+        while self.max_bytes is not None and self._nbytes > self.max_bytes:
+            alias = next(iter(self._cache))
+            if alias == keep:
+                break
+            self.release(alias)
+
+    def release(self, *aliases):
+        """Drop cached fields (all of them if no aliases are given)"""
+
+        if not aliases:
+            aliases = list(self._cache.keys())
+
+        for alias in aliases:
+            value = self._cache.pop(alias, None)
+            if value is not None:
+                self._nbytes -= value.nbytes
+
+        return
+
+    def subregion(self, **region):
+        """Return a new ZeusData restricted to a region of the full grid"""
+        return ZeusData(self.filename, self.max_bytes, self.dtype, **region)
+
+    @property
+    def cached(self):
+        return list(self._cache.keys())
+
+    def close(self):
+        """Release all cached fields and close the underlying file"""
+        self.release()
+        if self._zf is not None:
+            self._zf.close()
+            self._zf = None
+
+    def __getstate__(self):
+        # h5py handles cannot be pickled; reopen on demand instead
+        state = self.__dict__.copy()
+        state["_zf"] = None
+        return state
 
     def __enter__(self):
         return self
 
     def __exit__(self, etype,evalue, tb):
-        pass
+        self.close()
 
 class Error(Exception):
     pass
@@ -59,53 +251,446 @@ class ComparisonError(Error):
        self.value1 = value1
        self.value2 = value2
 
+def _skip_mask(locs, iskip = (), jskip = (), kskip = ()):
+    """Boolean mask of the (k, j, i) locations not in any skip list"""
+
+    # pad lower dimensional locations out to (k, j, i)
+    locs = (np.zeros_like(locs[0]),) * (3 - len(locs)) + tuple(locs[-3:])
+    k, j, i = locs
+
+    return ~(np.isin(i, iskip) | np.isin(j, jskip) | np.isin(k, kskip))
+
+def _show_locs(locs, rerr, aerr, mask, out):
+    diff_fmt = "    Does not match at ({:4d},{:4d},{:4d})  |  diff = ({:8.2E}, {:8.2E})"
+    locs = (np.zeros_like(locs[0]),) * (3 - len(locs)) + tuple(locs[-3:])
+    k, j, i = [l[mask] for l in locs]
+    lines = [diff_fmt.format(*row) for row in
+             zip(i.tolist(), j.tolist(), k.tolist(),
+                 rerr[mask].tolist(), aerr[mask].tolist())]
+    if lines:
+        out.write("\n".join(lines) + "\n")
+
 class DifferenceError(Error):
 
-   def __init__(self, var, rerr, aerr, locs, rtol):
+   def __init__(self, var, rerr, aerr, locs, rtol, rerr_max = None, aerr_max = None):
        self.var = var
        self.rerr = rerr
        self.aerr = aerr
        self.locs = locs
        self.rtol = rtol
+       self.rerr_max = rerr.max() if rerr_max is None else rerr_max
+       self.aerr_max = aerr.max() if aerr_max is None else aerr_max
+
+   def showall(self, iskip = (), jskip = (), kskip = (), stream = None):
+       out = sys.stdout if stream is None else stream
+       mask = _skip_mask(self.locs, iskip, jskip, kskip)
+       _show_locs(self.locs, self.rerr, self.aerr, mask, out)
+
+
+# log10 relative error bin edges used for the per-field histograms
+rerr_hist_edges = np.arange(-16, 1)
+
+class FieldComparison:
+    """Error statistics of one field of a comparison
+
+    locs are the index arrays (k, j, i) of the failing cells, worst
+    first, and rerr and aerr are their relative and absolute errors.
+    Only the nworst worst cells are kept, unless nworst was None.
+    hist counts every cell with a nonzero error by log10 relative
+    error: hist[0] is below 10**rerr_hist_edges[0], hist[-1] is at or
+    above 10**rerr_hist_edges[-1].  Cells whose error is not finite
+    (NaN or infinite values) are counted in ndiff and in nnonfinite
+    instead of hist.  identical is set when the field was
+    matched by content digest and never compared numerically.
+    """
+
+    def __init__(self, var, size, nfail, ndiff, rerr_max, aerr_max,
+                 locs, rerr, aerr, hist, nnonfinite = 0):
+        self.var = var
+        self.size = size
+        self.nfail = nfail
+        self.ndiff = ndiff
+        self.rerr_max = rerr_max
+        self.aerr_max = aerr_max
+        self.locs = locs
+        self.rerr = rerr
+        self.aerr = aerr
+        self.hist = hist
+        self.nnonfinite = nnonfinite
+        self.identical = False
+
+    @property
+    def close(self):
+        return self.nfail == 0
+
+    def mask(self, iskip = (), jskip = (), kskip = ()):
+        """Boolean mask selecting the failing cells outside the skip lists"""
+        return _skip_mask(self.locs, iskip, jskip, kskip)
+
+    def showall(self, iskip = (), jskip = (), kskip = (), stream = None):
+        out = sys.stdout if stream is None else stream
+        _show_locs(self.locs, self.rerr, self.aerr,
+                   self.mask(iskip, jskip, kskip), out)
+
+    def summary(self):
+        return ("{:3s} {:10d} / {:10d} fail  {:10d} differ  "
+                "max rerr {:8.2E}  max aerr {:8.2E}").format(
+                    self.var, self.nfail, self.size, self.ndiff,
+                    self.rerr_max, self.aerr_max)
+
+    def show_hist(self, stream = None):
+        out = sys.stdout if stream is None else stream
+        labels = (["< 1E{:+03d}".format(rerr_hist_edges[0])] +
+                  ["1E{:+03d}".format(e) for e in rerr_hist_edges])
+        for label, count in zip(labels, self.hist):
+            if count:
+                print("    rerr {:>9s}  {:10d}".format(label, count), file = out)
+        if self.nnonfinite:
+            print("    rerr {:>9s}  {:10d}".format("nonfinite", self.nnonfinite), file = out)
+
+
+# rough number of block-sized temporaries alive during a block comparison
+_block_temporaries = 8
+
+def _blocks(shape, itemsize, max_bytes):
+    """Yield index tuples that tile an array in blocks of at most max_bytes
+
+    Blocks are slabs along the outermost axis whose trailing sub-array
+    fits in max_bytes; outer axes are stepped over one index at a time.
+    """
+
+    if len(shape) == 0:
+        yield ()
+        return
+
+    for axis in range(len(shape)):
+        inner = itemsize * int(np.prod(shape[axis+1:]))
+        if inner <= max_bytes:
+            break
+
+    step = max(1, max_bytes // inner)
+
+    for outer in np.ndindex(*shape[:axis]):
+        for start in range(0, shape[axis], step):
+            yield outer + (slice(start, min(start + step, shape[axis])),)
+
+
+def _rank(rerr):
+    # NaN errors rank as the worst of all
+    return np.where(np.isnan(rerr), np.inf, rerr)
+
+
+class _ErrorTracker:
+    """Running error statistics of a blockwise comparison
+
+    Keeps the maximum relative and absolute errors, the number of
+    cells that are not close and the nworst worst of those cells
+    (ranked by relative error), and histograms the relative error of
+    every cell that differs at all.
+    """
+
+    def __init__(self, shape, rtol, atol, nworst):
+        self.shape = shape
+        self.rtol = rtol
+        self.atol = atol
+        self.nworst = nworst
+        self.digests = None
+
+        self.nfail = 0
+        self.ndiff = 0
+        self.nnonfinite = 0
+        self.hist = np.zeros(len(rerr_hist_edges) + 1, dtype = np.int64)
+        self.rerr_max = 0.0
+        self.aerr_max = 0.0
+        self._flat = np.empty(0, dtype = np.intp)
+        self._rerr = np.empty(0)
+        self._aerr = np.empty(0)
+
+    @property
+    def close(self):
+        return self.nfail == 0
+
+    def update(self, a, b, index):
+
+        a = np.asarray(a)
+        b = np.asarray(b)
+
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            # equal cells (including matching infinities) have no error;
+            # NaNs give NaN errors, which are propagated to the maxima
+            aerr = np.where(a == b, 0.0, np.abs(a - b))
+            rerr = np.where(aerr == 0, 0.0, aerr / np.abs(a + b))
+            ok = (np.isclose(a, b, rtol = self.rtol, atol = self.atol) &
+                  np.isclose(b, a, rtol = self.rtol, atol = self.atol))
+
+        if aerr.size:
+            self.rerr_max = float(np.maximum(self.rerr_max, rerr.max()))
+            self.aerr_max = float(np.maximum(self.aerr_max, aerr.max()))
+
+        # NaN errors count as differences too, in a bin of their own
+        differ = rerr[aerr != 0]
+        if differ.size:
+            self.ndiff += differ.size
+            finite = np.isfinite(differ)
+            self.nnonfinite += differ.size - int(finite.sum())
+            with np.errstate(divide = "ignore"):
+                bins = np.searchsorted(rerr_hist_edges, np.log10(differ[finite]),
+                                       side = "right")
+            self.hist += np.bincount(bins, minlength = self.hist.size)
+
+        bad = np.nonzero(~ok)
+        if len(bad[0]) == 0:
+            return
+
+        # map block-local indices back to the full array
+        nouter = len(index) - 1
+        locs = [np.full(len(bad[0]), i, dtype = np.intp) for i in index[:nouter]]
+        locs.append(bad[0] + index[-1].start)
+        locs.extend(bad[1:])
+        flat = np.ravel_multi_index(locs, self.shape)
+
+        self.nfail += flat.size
+        self._keep(flat, rerr[bad], aerr[bad])
+
+    def _keep(self, flat, rerr, aerr):
+
+        self._flat = np.concatenate((self._flat, flat))
+        self._rerr = np.concatenate((self._rerr, rerr))
+        self._aerr = np.concatenate((self._aerr, aerr))
+
+        if self.nworst is not None and self._flat.size > self.nworst:
+            keep = np.argpartition(-_rank(self._rerr), self.nworst - 1)[:self.nworst]
+            self._flat = self._flat[keep]
+            self._rerr = self._rerr[keep]
+            self._aerr = self._aerr[keep]
+
+    def worst(self):
+        """Return (locs, rerr, aerr) of the worst cells, worst first"""
+        order = np.argsort(-_rank(self._rerr), kind = "stable")
+        locs = np.unravel_index(self._flat[order], self.shape)
+        return locs, self._rerr[order], self._aerr[order]
+
+    def result(self, var = None):
+        locs, rerr, aerr = self.worst()
+        return FieldComparison(var, int(np.prod(self.shape)), self.nfail,
+                               self.ndiff, self.rerr_max, self.aerr_max,
+                               locs, rerr, aerr, self.hist, self.nnonfinite)
+
+    def error(self, var = None):
+        locs, rerr, aerr = self.worst()
+        return DifferenceError(var, rerr, aerr, locs, self.rtol,
+                               self.rerr_max, self.aerr_max)
+
+
+class _Digest:
+    """Running SHA-1 digest of an array fed in C-order blocks
+
+    NaN never compares equal, so an array holding any NaN has no digest
+    (hexdigest() is None) and cannot be matched by content.
+    """
+
+    def __init__(self, dtype, shape):
+        self._sha1 = hashlib.sha1()
+        self._sha1.update(str(dtype).encode())
+        self._sha1.update(str(shape).encode())
+        self._nan = False
+
+    def update(self, block):
+        block = np.ascontiguousarray(block)
+        if not self._nan and block.dtype.kind in "fc":
+            self._nan = bool(np.isnan(block).any())
+        self._sha1.update(block.tobytes())
+
+    def hexdigest(self):
+        return None if self._nan else self._sha1.hexdigest()
+
+def _digest_stamp(filename):
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime]
+
+def cached_digests(filename):
+    """Digests stored in a dump's sidecar, if it is still current
+
+    The sidecar (the dump name with .digests appended) is only trusted
+    while the dump's size and mtime are unchanged.
+    """
+
+    try:
+        with open(filename + ".digests", "r") as f:
+            stored = json.load(f)
+        return stored["digests"] if stored["stamp"] == _digest_stamp(filename) else {}
+    except (IOError, OSError, ValueError, KeyError):
+        return {}
+
+def store_digests(filename, digests):
+    """Add digests to a dump's sidecar"""
+
+    merged = cached_digests(filename)
+    merged.update(digests)
+
+    try:
+        with open(filename + ".digests", "w") as f:
+            json.dump({"stamp": _digest_stamp(filename), "digests": merged}, f)
+    except (IOError, OSError):
+        pass
+
+def compare_arrays(a, b, rtol = 1e-15, atol = 0, max_bytes = 2**27, nworst = 100,
+                   digests = False):
+    """Compare two arrays (or HDF5 datasets) block by block
+
+    Only blocks of roughly max_bytes are held in memory at once, so a and
+    b may be h5py datasets that are much larger than memory.  Returns an
+    _ErrorTracker holding the running error statistics.  With digests
+    set, the content digests of a and b are computed from the same
+    blocks and kept in the tracker's digests.  Blocks that are equal
+    element for element (which rules out NaN) have no error to measure
+    and skip the numerical comparison.
+    """
+
+    if a.shape != b.shape:
+        raise ValueError("shapes differ: {} != {}".format(a.shape, b.shape))
+
+    h = [_Digest(a.dtype, a.shape), _Digest(b.dtype, b.shape)] if digests else None
+
+    if len(a.shape) == 0:
+        a = np.reshape(a[()], (1,))
+        b = np.reshape(b[()], (1,))
+
+    itemsize = max(a.dtype.itemsize, b.dtype.itemsize, 8) * _block_temporaries
+    tracker = _ErrorTracker(a.shape, rtol, atol, nworst)
+
+    for index in _blocks(a.shape, itemsize, max_bytes):
+        block_a = a[index]
+        block_b = b[index]
+        if not np.array_equal(block_a, block_b):
+            tracker.update(block_a, block_b, index)
+        if h:
+            h[0].update(block_a)
+            h[1].update(block_b)
+
+    if h:
+        tracker.digests = (h[0].hexdigest(), h[1].hexdigest())
+
+    return tracker
+
+def assert_near_equality(a,b, rtol = 1e-15, atol = 0, max_bytes = 2**27, nworst = 100):
+
+    tracker = compare_arrays(a, b, rtol, atol, max_bytes, nworst)
+
+    if not tracker.close:
+        raise tracker.error()
 
-   def showall(self, iskip = (), jskip = (), kskip = () ):
-       diff_fmt = "    Does not match at ({:4d},{:4d},{:4d})  |  diff = ({:8.2E}, {:8.2E})"
-       for (k,j,i) in  zip(*self.locs):
-           if not ((i in iskip) or (j in jskip) or (k in kskip)):
-               if self.rerr[k,j,i] > self.rtol: 
-                   print(diff_fmt.format(i,j,k,self.rerr[k,j,i],self.aerr[k,j,i]))
-
-def assert_near_equality(a,b, rtol = 1e-15, atol = 0):
-
-    c1 = np.allclose(a,b,rtol = rtol, atol = atol)
-    c2 = np.allclose(b,a,rtol = rtol, atol = atol)
-    
-    if not (c1 and c2):
-        rerr  = np.abs(a-b) / np.abs(a+b) 
-        aerr  = np.abs(a-b)
-        locs = aerr.nonzero()
-        raise DifferenceError(None, rerr, aerr, locs, rtol)
-        
     return
 
-def assert_equality(a,b):
+def assert_equality(a,b, max_bytes = 2**27, nworst = 100):
+
+    assert_near_equality(a, b, 0, 0, max_bytes, nworst)
 
-    if not np.array_equal(a,b):
-        rerr  = np.abs(a-b) / np.abs(a+b) 
-        aerr  = np.abs(a-b)
-        locs = aerr.nonzero()
-        raise DifferenceError(None, rerr, aerr, locs, rtol)
-        
     return
                     
+class ComparisonResult:
+    """Outcome of comparing two dumps
+
+    status is "match", "differ" (some field is not close),
+    "incomparable" (times, grid sizes or coordinates differ) or "error"
+    (the comparison itself failed, e.g. on an unreadable file).  fields
+    maps each compared variable to its FieldComparison.  log holds
+    everything that was printed for this pair.
+    """
+
+    def __init__(self, file1, file2):
+        self.file1 = file1
+        self.file2 = file2
+        self.status = "match"
+        self.fields = OrderedDict()
+        self.elapsed = 0.0
+        self.log = ""
+
+    @property
+    def ok(self):
+        return self.status == "match"
+
+    @property
+    def identical(self):
+        """True if every compared field was bit-for-bit identical"""
+        return (self.ok and len(self.fields) > 0 and
+                all(field.identical for field in self.fields.values()))
+
+    def show(self, hist = False, stream = None):
+        """Print per-field summary statistics (and error histograms)"""
+        out = sys.stdout if stream is None else stream
+        print("{} vs {}: {}".format(self.file1, self.file2, self.status), file = out)
+        for field in self.fields.values():
+            print("  " + field.summary(), file = out)
+            if hist:
+                field.show_hist(stream = out)
+        return
+
+class ComparisonReport(list):
+    """ComparisonResults of a set of dump pairs, in dump order"""
+
+    @property
+    def ok(self):
+        return all(result.ok for result in self)
+
+    @property
+    def elapsed(self):
+        return sum(result.elapsed for result in self)
+
+    def show(self, stream = None):
+        out = sys.stdout if stream is None else stream
+        row_fmt = "  {:24s} {:12s} {:8.2f} s  {}"
+        for result in self:
+            worst = ""
+            if result.fields:
+                var = max(result.fields, key = lambda v: _rank(result.fields[v].rerr_max))
+                worst = "max rerr {:8.2E} ({})".format(result.fields[var].rerr_max, var)
+            print(row_fmt.format(os.path.basename(result.file1), result.status,
+                                 result.elapsed, worst), file = out)
+        return
+
 def compare_two(file1, file2, rtol = 1e8, 
-                unforgiving = True, verbose = True, force = False):
+                unforgiving = True, verbose = True, force = False,
+                max_bytes = 2**27, nworst = 100, stream = None,
+                digests = True, cache_digests = False):
+    """Compare two dumps and return a ComparisonResult
+
+    With digests set, fields whose cached digests (see cached_digests)
+    agree in both dumps are reported as identical without being read.
+    With cache_digests set, the digests of the fields that are compared
+    are computed from the blocks read for the comparison and stored in
+    each dump's sidecar for later runs.  Fields holding NaN have no
+    digest, so NaN always fails, as in compare_arrays.
+    """
 
-    print("Comparing {} with {}".format(file1, file2))
+    out = sys.stdout if stream is None else stream
+    result = ComparisonResult(file1, file2)
+    start = time.time()
+
+    print("Comparing {} with {}".format(file1, file2), file = out)
 
     f1 = ZeusFile(file1) 
     f2 = ZeusFile(file2) 
 
+    h1 = cached_digests(file1) if digests else {}
+    h2 = cached_digests(file2) if digests else {}
+    new1 = {}
+    new2 = {}
+
+    def _check(axis):
+        if h1.get(axis) is not None and h1.get(axis) == h2.get(axis):
+            tracker = _ErrorTracker(f1[dset_aliases[axis]].shape, rtol, 0, nworst)
+            result.fields[axis] = tracker.result(axis)
+            result.fields[axis].identical = True
+            return
+        tracker = compare_arrays(f1[dset_aliases[axis]], f2[dset_aliases[axis]],
+                                 rtol, 0, max_bytes, nworst, digests = cache_digests)
+        if cache_digests:
+            new1[axis], new2[axis] = tracker.digests
+        result.fields[axis] = tracker.result(axis)
+        if not tracker.close:
+            raise tracker.error(axis)
+
     try: # try to compare the files
 
         # check that time stamps are the same
@@ -134,63 +719,309 @@ def compare_two(file1, file2, rtol = 1e8,
 
         # check that velocities are the same
         for axis in ['v1','v2','v3']:
-            c1 = f1.get_dset(axis)
-            c2 = f2.get_dset(axis)
             try:
-                assert_near_equality(c1,c2, rtol)
+                _check(axis)
             except DifferenceError as DE:
-                DE.var = axis
-
                 if unforgiving:
                     raise DE
                 else:
+                    result.status = "differ"
                     msg_str = "  Files do not match: {:} differs (max = {:8.2E}) "
-                    print(msg_str.format(DE.var, DE.rerr.max()))
-                    if verbose: DE.showall()
+                    print(msg_str.format(DE.var, DE.rerr_max), file = out)
+                    if verbose: DE.showall(stream = out)
 
         # check that physical variables are the same
         for axis in ["e","d", "gp"]:
-            c1 = f1.get_dset(axis)
-            c2 = f2.get_dset(axis)
             try:
-                assert_near_equality(c1,c2, rtol)
+                _check(axis)
             except DifferenceError as DE:
-                DE.var = axis
-
                 if unforgiving:
                     raise DE
                 else:
+                    result.status = "differ"
                     msg_str = "  Files do not match: {:} differs (max = {:8.2E}) "
-                    print(msg_str.format(DE.var, DE.rerr.max()))
-                    if verbose: DE.showall()
+                    print(msg_str.format(DE.var, DE.rerr_max), file = out)
+                    if verbose: DE.showall(stream = out)
                 
 
     except ComparisonError as CE:
+        result.status = "incomparable"
         msg_str = "  Cannot compare files: {:} differs [{:18.12E} != {:18.12E}]"
-        print(msg_str.format(CE.var, CE.value1, CE.value2))
+        print(msg_str.format(CE.var, CE.value1, CE.value2), file = out)
 
     except DifferenceError as DE:
         if DE.var in ['x1','x2','x3']: # if coordinates differ
+            result.status = "incomparable"
             msg_str = "  Cannot compare files: {:} differs"
-            print(msg_str.format(DE.var))
+            print(msg_str.format(DE.var), file = out)
         else:
+            result.status = "differ"
             msg_str = "  Files do not match: {:} differs (max = {:8.2E}) "
-            print(msg_str.format(DE.var, DE.diff.max()))
-            if verbose: DE.showall()
+            print(msg_str.format(DE.var, DE.rerr_max), file = out)
+            if verbose: DE.showall(stream = out)
 
     finally:
         f1.close()
         f2.close()
 
-    return
+    if new1:
+        store_digests(file1, new1)
+        store_digests(file2, new2)
+
+    result.elapsed = time.time() - start
+    if isinstance(out, io.StringIO):
+        result.log = out.getvalue()
+
+    return result
+
+def _failed_comparison(file1, file2, exc, log = ""):
+    # a ComparisonResult standing in for a pair whose comparison raised
+    result = ComparisonResult(file1, file2)
+    result.status = "error"
+    result.log = log + "  Comparison failed: {}: {}\n".format(type(exc).__name__, exc)
+    return result
+
+def _compare_pair(args):
+    # worker for compare_output; buffers the log so it can be replayed in order
+    file1, file2, kwargs = args
+    stream = io.StringIO()
+    try:
+        return compare_two(file1, file2, stream = stream, **kwargs)
+    except Exception as exc:
+        return _failed_comparison(file1, file2, exc, stream.getvalue())
 
 def compare_output(output1, output2, rtol = 1e-8, 
-                   unforgiving = True, verbose = True, force = False):
-    
-    for file1, file2 in zip(output1.files, output2.files):
-        compare_two(file1,file2, rtol, unforgiving, verbose, force)
+                   unforgiving = True, verbose = True, force = False,
+                   max_bytes = 2**27, nworst = 100,
+                   nworkers = 1, pool = "process",
+                   digests = True, cache_digests = False):
+    """Compare matching dumps of two runs and return a ComparisonReport
+
+    With nworkers > 1 the pairs are compared concurrently in a process
+    pool (or a thread pool if pool = "thread", which is enough when the
+    comparison is I/O bound).  Each pair's messages are still printed
+    in dump order once it is done.  A pair whose comparison raises is
+    recorded with status "error" and the others still run.
+    """
+
+    kwargs = dict(rtol = rtol, unforgiving = unforgiving, verbose = verbose,
+                  force = force, max_bytes = max_bytes, nworst = nworst,
+                  digests = digests, cache_digests = cache_digests)
+    # pair readable dumps by name, so a dump still being written in
+    # either run is left out rather than shifting the pairing
+    dumps2 = dict((os.path.basename(f), f) for f in output2.dumps)
+    pairs = [(f, dumps2[os.path.basename(f)]) for f in output1.dumps
+             if os.path.basename(f) in dumps2]
+
+    report = ComparisonReport()
+
+    if nworkers <= 1:
+        for file1, file2 in pairs:
+            try:
+                result = compare_two(file1, file2, **kwargs)
+            except Exception as exc:
+                result = _failed_comparison(file1, file2, exc)
+                sys.stdout.write(result.log)
+            report.append(result)
+        return report
+
+    if pool == "process":
+        executor = concurrent.futures.ProcessPoolExecutor(nworkers)
+    elif pool == "thread":
+        executor = concurrent.futures.ThreadPoolExecutor(nworkers)
+    else:
+        raise ValueError("unknown pool type {}".format(pool))
+
+    with executor:
+        futures = [executor.submit(_compare_pair, (file1, file2, kwargs))
+                   for file1, file2 in pairs]
+        for (file1, file2), future in zip(pairs, futures):
+            try:
+                result = future.result()
+            except Exception as exc:
+                # e.g. a worker process that died
+                result = _failed_comparison(file1, file2, exc)
+            sys.stdout.write(result.log)
+            report.append(result)
+
+    return report
+
+class DumpCatalog:
+    """Summary of every dump in an output directory, cached in a sidecar
+
+    For each dump the catalog records the simulation time, grid shape,
+    available aliases, file size and modification time.  It is stored
+    as JSON next to the dumps and refreshed incrementally: only files
+    that are new or whose size or mtime changed are reopened.  Lookups
+    by time are binary searches on the cached times.
+    """
+
+    sidecar = ".zeustools_catalog.json"
+
+    def __init__(self, datadir, files, cache = True):
+        self.datadir = datadir
+        self.cache = cache
+        self.entries = OrderedDict()
+
+        if cache:
+            self._load()
+
+        self.refresh(files)
+
+    @property
+    def path(self):
+        return os.path.join(self.datadir, self.sidecar)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                self.entries = OrderedDict(json.load(f))
+        except (IOError, OSError, ValueError):
+            self.entries = OrderedDict()
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+        except (IOError, OSError):
+            pass # read-only directories just go uncached
+
+    @staticmethod
+    def _scan(filename, size, mtime):
+        with ZeusFile(filename, "r") as zf:
+            shape = zf[dset_aliases["d"]].shape
+            return {"time"    : float(zf.get_dset("t")[0]),
+                    "shape"   : list(shape),
+                    "aliases" : [alias for alias, name in dset_aliases.items()
+                                 if name in zf],
+                    "size"    : size,
+                    "mtime"   : mtime}
+
+    def refresh(self, files):
+        """Bring the catalog up to date with the given list of dumps"""
+
+        entries = OrderedDict()
+        changed = False
+
+        for filename in files:
+            name = os.path.basename(filename)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+
+            entry = self.entries.get(name)
+            if (entry is None or entry["size"] != st.st_size or
+                entry["mtime"] != st.st_mtime):
+                try:
+                    entry = self._scan(filename, st.st_size, st.st_mtime)
+                except (IOError, OSError, KeyError):
+                    continue # not a readable dump (yet)
+                changed = True
+
+            entries[name] = entry
+
+        changed = changed or list(entries) != list(self.entries)
+        self.entries = entries
+
+        names = list(entries.keys())
+        times = np.array([entries[name]["time"] for name in names])
+        order = np.argsort(times, kind = "stable")
+        self._names = [names[n] for n in order]
+        self._times = times[order]
+
+        if changed and self.cache:
+            self._save()
+
+        return
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, name):
+        return self.entries[os.path.basename(name)]
+
+    def _fullpath(self, name):
+        return os.path.join(self.datadir, name)
+
+    @property
+    def files(self):
+        return [self._fullpath(name) for name in self.entries]
+
+    @property
+    def times(self):
+        return np.array([entry["time"] for entry in self.entries.values()])
+
+    def nearest(self, t):
+        """Return the dump whose time is closest to t"""
+
+        if not self._names:
+            raise ValueError("no dumps in {}".format(self.datadir))
+
+        n = int(np.searchsorted(self._times, t))
+        if n == len(self._times) or (n > 0 and
+                                     t - self._times[n-1] <= self._times[n] - t):
+            n -= 1
+
+        return self._fullpath(self._names[n])
+
+    def between(self, tmin = None, tmax = None):
+        """Return the dumps with tmin <= time <= tmax, in time order"""
+
+        lo = 0 if tmin is None else np.searchsorted(self._times, tmin, side = "left")
+        hi = len(self._times) if tmax is None else np.searchsorted(self._times, tmax, side = "right")
+
+        return [self._fullpath(name) for name in self._names[lo:hi]]
+
+
+_reductions = {"max": np.max, "min": np.min, "sum": np.sum, "mean": np.mean}
+
+def _sample_dump(args):
+    # worker for ZeusMPOutput.timeseries; reads one dump's selection
+    filename, field, reduce, weight, region = args
+
+    with ZeusFile(filename, "r") as zf:
+        t = zf.get_dset("t")[0]
+        values = zf.get_dset(field, **region)
+
+        if reduce is None:
+            return t, np.squeeze(values)
+
+        if reduce not in _reductions:
+            raise ValueError("unknown reduction {}".format(reduce))
+
+        # reduce over the spatial axes only, keeping e.g. species
+        dV = zf.volume(**region)
+        axes = tuple(range(-dV.ndim, 0))
+
+        if weight is None or reduce in ("max", "min"):
+            return t, _reductions[reduce](values, axis = axes)
+
+        if weight == "dV":
+            w = dV
+        elif weight == "dm":
+            w = dV * zf.get_dset("d", **region)
+        else:
+            raise ValueError("unknown weight {}".format(weight))
+
+        total = np.sum(values * w, axis = axes)
+        if reduce == "mean":
+            total = total / np.sum(w)
+
+        return t, total
+
+
+def _readable(filename):
+    # a dump counts as readable once HDF5 can open it and find the time
+    try:
+        with ZeusFile(filename, "r") as zf:
+            zf.get_dset("t")
+    except (IOError, OSError, KeyError):
+        return False
+    return True
 
-    return
 
 class ZeusMPOutput:
 
@@ -198,6 +1029,134 @@ class ZeusMPOutput:
         self.datadir = datadir
         self.files = glob.glob(os.path.join(datadir, "hdfaa.???"))
         self.files.sort()
+        self._catalog = None
+
+    @property
+    def catalog(self):
+        """DumpCatalog of this directory, built on first use"""
+        if self._catalog is None:
+            self._catalog = DumpCatalog(self.datadir, self.files)
+        return self._catalog
+
+    def refresh(self):
+        """Pick up new or changed dumps"""
+        self.files = glob.glob(os.path.join(self.datadir, "hdfaa.???"))
+        self.files.sort()
+        if self._catalog is not None:
+            self._catalog.refresh(self.files)
+
+    def nearest(self, t):
+        return self.catalog.nearest(t)
+
+    def between(self, tmin = None, tmax = None):
+        return self.catalog.between(tmin, tmax)
+
+    @property
+    def dumps(self):
+        """Readable dumps, in time order (unlike the raw glob in files)"""
+        return self.catalog.between()
+
+    def timeseries(self, field, reduce = None, weight = None,
+                   tmin = None, tmax = None, nthreads = 4, **region):
+        """Extract a field (or a reduction of it) from every dump
+
+        region selects a point, ray, slice or sub-volume as in
+        ZeusFile.selection, and only that hyperslab is read from each
+        dump.  reduce may be None (keep the selection), "max", "min",
+        "sum" or "mean"; with weight = "dV" or "dm" the sum and mean are
+        volume or mass weighted.  The readable dumps of the catalog between
+        tmin and tmax are read concurrently by nthreads threads.
+
+        Returns the times and an array of shape (time, selection) or,
+        when reduced, (time,).
+        """
+
+        # the catalog leaves out dumps that cannot be read (yet)
+        files = self.between(tmin, tmax)
+
+        tasks = [(filename, field, reduce, weight, region) for filename in files]
+
+        if nthreads > 1:
+            with concurrent.futures.ThreadPoolExecutor(nthreads) as executor:
+                samples = list(executor.map(_sample_dump, tasks))
+        else:
+            samples = [_sample_dump(task) for task in tasks]
+
+        times = np.array([t for t, _ in samples])
+        values = np.array([v for _, v in samples])
+
+        return times, values
+
+    def follow(self, start = None, poll = 5.0, settle = 2.0,
+               timeout = None, stop = None):
+        """Yield the dumps of a running simulation as they are completed
+
+        Dumps are yielded in name order, each only once it is complete:
+        either a later dump exists or its size and mtime have not changed
+        for settle seconds, and in both cases it can be opened and its
+        time read.  start is the name (or path) of the last dump already
+        processed, so a pipeline can resume where it left off; the name
+        of the last dump yielded is kept in self.position.
+
+        Following ends once stop() returns true (e.g. when the ZEUS-MP
+        process has exited) and the remaining dumps have been yielded,
+        or after timeout seconds without a new dump.
+        """
+
+        self.position = None if start is None else os.path.basename(start)
+        seen = {}
+        last_new = time.time()
+        finishing = False
+
+        while True:
+            files = sorted(glob.glob(os.path.join(self.datadir, "hdfaa.???")))
+            names = [os.path.basename(f) for f in files]
+            found = False
+
+            for n, filename in enumerate(files):
+                name = names[n]
+                if self.position is not None and name <= self.position:
+                    continue
+
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    break
+
+                now = time.time()
+                signature = (st.st_size, st.st_mtime)
+                if name not in seen or seen[name][0] != signature:
+                    seen[name] = (signature, now)
+
+                settled = finishing or now - seen[name][1] >= settle
+                if not ((n + 1 < len(files) or settled) and _readable(filename)):
+                    break
+
+                self.position = name
+                seen.pop(name)
+                found = True
+                yield filename
+
+            if found:
+                last_new = time.time()
+                continue
+
+            if finishing:
+                break
+
+            if stop is not None and stop():
+                # the writer is done, so whatever is left is complete
+                finishing = True
+                continue
+
+            if timeout is not None and time.time() - last_new > max(timeout, settle):
+                break
+
+            time.sleep(poll)
+
+        self.refresh()
+
+        return
 
 
 
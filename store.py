@@ -0,0 +1,145 @@
+"""Consolidate the HDF5 dumps of a run into one time-indexed store"""
+import h5py
+import numpy as np
+import os
+
+from .output import ZeusData, ZeusFile, dset_aliases
+
+# aliases that describe the grid and composition, stored only once
+static_aliases = ("x1", "x2", "x3", "dV1", "dV2", "dV3", "A", "Z")
+
+
+def _default_chunks(shape):
+    # one (j, i) plane of one dump per chunk
+    return (1,) + tuple(1 for _ in shape[:-2]) + tuple(shape[-2:])
+
+def consolidate(output, storefile, aliases = None,
+                compression = "gzip", compression_opts = 4, chunks = None):
+    """Write every readable dump of a ZeusMPOutput into a single HDF5 store
+
+    The grid and composition datasets are copied once from the first
+    dump.  Each remaining alias (all that the first dump has, or just
+    those given) becomes a chunked, optionally compressed dataset with a
+    leading time axis.  Datasets keep their names from the dumps, so
+    the store reads through the usual aliases; see ZeusStore.
+    """
+
+    files = output.dumps
+    if not files:
+        raise ValueError("no dumps in {}".format(output.datadir))
+
+    with ZeusFile(files[0], "r") as first:
+        if aliases is None:
+            aliases = [alias for alias, name in dset_aliases.items()
+                       if name in first and alias != "t"]
+
+        static = [alias for alias in aliases if alias in static_aliases]
+        fields = [alias for alias in aliases if alias not in static_aliases]
+
+        with h5py.File(storefile, "w") as store:
+            store.attrs["datadir"] = os.path.abspath(output.datadir)
+            store.create_dataset("files", data = np.array(
+                [os.path.basename(f).encode() for f in files]))
+
+            for alias in static:
+                store.create_dataset(dset_aliases[alias],
+                                     data = first.get_dset(alias))
+
+            times = store.create_dataset(dset_aliases["t"], (len(files),),
+                                         dtype = np.float64)
+
+            dsets = {}
+            for alias in fields:
+                src = first[dset_aliases[alias]]
+                dsets[alias] = store.create_dataset(
+                    dset_aliases[alias], (len(files),) + src.shape,
+                    dtype = src.dtype,
+                    chunks = chunks or _default_chunks(src.shape),
+                    compression = compression,
+                    compression_opts = compression_opts if compression else None)
+
+            for n, filename in enumerate(files):
+                with ZeusFile(filename, "r") as zf:
+                    times[n] = zf.get_dset("t")[0]
+                    for alias, dset in dsets.items():
+                        src = zf[dset_aliases[alias]]
+                        if src.shape != dset.shape[1:]:
+                            raise ValueError("{} in {} has shape {}, expected {}".format(
+                                alias, filename, src.shape, dset.shape[1:]))
+                        dset[n] = src[()]
+
+    return storefile
+
+
+class ZeusStore(ZeusFile):
+    """Reader for stores written by consolidate
+
+    get_dset takes the same aliases and region keywords as
+    ZeusFile.get_dset, plus n to pick a dump (an index or a slice along
+    the time axis) for time-dependent fields.
+    """
+
+    @property
+    def times(self):
+        return self[dset_aliases["t"]][:]
+
+    @property
+    def files(self):
+        return [f.decode() for f in self["files"][:]]
+
+    def nearest(self, t):
+        """Index of the dump whose time is closest to t"""
+        return int(np.argmin(np.abs(self.times - t)))
+
+    def between(self, tmin = None, tmax = None):
+        """Slice of the dumps with tmin <= time <= tmax"""
+        times = self.times
+        lo = 0 if tmin is None else int(np.searchsorted(times, tmin, side = "left"))
+        hi = len(times) if tmax is None else int(np.searchsorted(times, tmax, side = "right"))
+        return slice(lo, hi)
+
+    def get_dset(self, name, dtype = None, n = None, **region):
+
+        if name in static_aliases:
+            return ZeusFile.get_dset(self, name, **region)
+
+        dset = self[dset_aliases[name]]
+        tindex = slice(None) if n is None else n
+
+        if name == "t":
+            return np.atleast_1d(dset[tindex])
+
+        sel = self.selection(**region)
+        index = self._hyperslab(name, dset, sel)
+        dset = self._cast(dset, dtype)
+
+        if index is Ellipsis:
+            return dset[tindex]
+
+        return dset[(tindex,) + index]
+
+    def data(self, n, **region):
+        """ZeusData-like view of dump n of the store"""
+        return ZeusStoreData(self.filename, n, **region)
+
+
+class ZeusStoreData(ZeusData):
+    """ZeusData for a single dump held in a consolidated store"""
+
+    def __init__(self, filename, n, max_bytes = 2**30, dtype = None, **region):
+        ZeusData.__init__(self, filename, max_bytes, dtype, **region)
+        self.n = n
+
+    def _open(self):
+        return ZeusStore(self.filename, "r")
+
+    def _read(self, alias):
+        return self._zf.get_dset(alias, self.dtype, n = self.n, **self.region)
+
+    def _read_region(self, alias, dtype = None, **region):
+        if self._zf is None:
+            self._zf = self._open()
+        return self._zf.get_dset(alias, dtype, n = self.n, **region)
+
+    def subregion(self, **region):
+        return ZeusStoreData(self.filename, self.n, self.max_bytes, self.dtype, **region)